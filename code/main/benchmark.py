@@ -0,0 +1,217 @@
+import tensorflow as tf
+import os
+import json
+import time
+import datetime
+import threading
+from pathlib import Path
+import modules.config as cn
+import modules.preprocessing as pp
+from main import parse_args
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+
+def resident_memory_mb():
+    """[Current resident memory of the process in MB, from /proc/self/statm.]"""
+    with open("/proc/self/statm") as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 ** 2)
+
+
+class MemorySampler:
+    """[This context manager samples the resident memory in a thread while a stage
+    is drained, its peak is the highest value above the memory at the start of
+    the stage, unlike the ru_maxrss of the whole process.]
+
+    Args:
+        interval (float, optional): [seconds between the samples]. Defaults to 0.05.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.stop = threading.Event()
+        self.start_mb = self.max_mb = 0.0
+
+    def sample(self):
+        while not self.stop.wait(self.interval):
+            self.max_mb = max(self.max_mb, resident_memory_mb())
+
+    def __enter__(self):
+        self.start_mb = self.max_mb = resident_memory_mb()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        self.thread.join()
+        self.max_mb = max(self.max_mb, resident_memory_mb())
+
+    @property
+    def peak_mb(self):
+        return self.max_mb - self.start_mb
+
+
+def drain(ds, max_batches):
+    """[This method iterates a dataset without any model and measures its throughput.]
+
+    Args:
+        ds ([tf dataset]): [batched dataset]
+        max_batches ([int]): [batches to drain, 0 drains the whole dataset]
+
+    Returns:
+        [dict]: [throughput metrics of the dataset]
+    """
+    if max_batches:
+        ds = ds.take(max_batches)
+
+    batches, images, time_to_first_batch = 0, 0, None
+    with MemorySampler() as memory:
+        start = time.perf_counter()
+        for batch in ds:
+            if time_to_first_batch is None:
+                time_to_first_batch = time.perf_counter() - start
+            batches += 1
+            # First component of the batch, i.e. the source images for the zip stage
+            images += int(tf.shape(tf.nest.flatten(batch)[0])[0])
+        seconds = time.perf_counter() - start
+
+    return {
+        "batches": batches,
+        "images": images,
+        "seconds": seconds,
+        "images_per_sec": images / seconds if seconds else 0.0,
+        "batches_per_sec": batches / seconds if seconds else 0.0,
+        "time_to_first_batch": time_to_first_batch,
+        # Peak resident memory of the stage above its starting level, in MB
+        "peak_memory_mb": memory.peak_mb,
+        "start_memory_mb": memory.start_mb,
+    }
+
+
+def stage_pipelines(domain, params):
+    """[This method builds the input pipeline of a domain up to every stage:
+    read, decode, preprocess & augment.]"""
+    batch_size = params["batch_size"]
+    manifest = pp.load_manifest(domain)
+
+    if params["use_cache"]:
+        shard_dir = pp.compile_domain(domain, params["resize"])
+        with open(shard_dir / "meta.json") as f:
+            meta = json.load(f)
+        files = tf.data.Dataset.list_files(str(shard_dir / "*.tfrecord"), shuffle=False)
+        read = files.interleave(
+            tf.data.TFRecordDataset,
+            cycle_length=meta["num_shards"],
+            num_parallel_calls=cn.AUTOTUNE,
+        ).batch(batch_size)
+        decode = read.map(
+            lambda x: pp.parse_examples(x, params["resize"]),
+            num_parallel_calls=cn.AUTOTUNE,
+        )
+        preprocess = pp.read_compiled_domain(domain, params, shuffle=False)
+    else:
+        files = tf.data.Dataset.from_tensor_slices(manifest["files"])
+        read = files.map(tf.io.read_file, num_parallel_calls=cn.AUTOTUNE).batch(
+            batch_size
+        )
+        if domain == "synsigns":
+            decode = files.map(
+                lambda x: pp.read_from_file(x, params["resize"]),
+                num_parallel_calls=cn.AUTOTUNE,
+            )
+        else:
+            decode = files.map(
+                lambda x: pp.load_image(x, params["resize"]),
+                num_parallel_calls=cn.AUTOTUNE,
+            )
+        decode = decode.batch(batch_size)
+        preprocess = pp.read_domain(domain, manifest, params)
+
+    augment = preprocess.map(pp.augment_ds, num_parallel_calls=cn.AUTOTUNE)
+
+    return {
+        "read": read,
+        "decode": decode,
+        "preprocess": preprocess,
+        "augment": augment,
+    }
+
+
+def benchmark_scenario(params, max_batches):
+    """[This method drains every stage of the input pipeline of a scenario.]"""
+    results = {}
+    source_domain, target_domain = cn.DOMAIN_PAIRS[
+        cn.DATASET_COMBINATION[params["combination"]]
+    ]
+
+    for role, domain in (("source", source_domain), ("target", target_domain)):
+        for stage, ds in stage_pipelines(domain, params).items():
+            tf.compat.v1.logging.info(f"Draining {role} {domain} {stage} stage ...")
+            results[f"{role}_{stage}"] = drain(ds.prefetch(cn.AUTOTUNE), max_batches)
+
+    ds_train, _ = pp.fetch_data(params)
+    steps = pp.train_steps(params)
+    if steps and not max_batches:
+        ds_train = ds_train.take(steps)
+    tf.compat.v1.logging.info("Draining the zipped training dataset ...")
+    results["zip"] = drain(ds_train, max_batches)
+
+    return results
+
+
+def main():
+    parser = parse_args()
+    parser.add_argument(
+        "--max_batches",
+        default=200,
+        help="Batches drained per stage, 0 drains the whole dataset",
+        type=int,
+    )
+    parser.add_argument(
+        "--scenarios",
+        default="",
+        help="Comma separated scenarios to benchmark, all of DATASET_COMBINATION if empty",
+        type=str,
+    )
+    parser.add_argument(
+        "--output",
+        default="",
+        help="Path of the json results, evaluation/benchmarks/ if empty",
+        type=str,
+    )
+    params = vars(parser.parse_args())
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
+
+    scenarios = (
+        params["scenarios"].split(",")
+        if params["scenarios"]
+        else list(cn.DATASET_COMBINATION)
+    )
+
+    results = {}
+    for scenario in scenarios:
+        params["combination"] = scenario
+        tf.compat.v1.logging.info(f"Benchmarking the input pipeline of {scenario}")
+        results[scenario] = benchmark_scenario(params, params["max_batches"])
+        for stage, metrics in results[scenario].items():
+            tf.compat.v1.logging.info(
+                f"{scenario} {stage}: {metrics['images_per_sec']:.1f} images/sec, "
+                f"{metrics['batches_per_sec']:.2f} batches/sec, first batch after "
+                f"{metrics['time_to_first_batch']:.2f}s"
+            )
+
+    output = params["output"] or os.path.join(
+        cn.EVALUATION,
+        "benchmarks",
+        "input_pipeline_" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".json",
+    )
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"params": params, "results": results}, f, indent=2)
+    tf.compat.v1.logging.info(f"Benchmark results saved at {output}")
+
+
+if __name__ == "__main__":
+    main()
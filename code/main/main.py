@@ -2,6 +2,14 @@ import tensorflow as tf
 import os
 import argparse
 from modules.train_test import train_test, evaluate
+from modules.preprocessing import compile_data
+from modules.feature_cache import train_head
+from modules.serving import export
+from modules.channel_pruning import channel_prune
+from modules.quantization import quantize
+from modules.distillation import distill
+from modules.inference_server import serve, load_test
+from modules.config import STATEFUL_LOSSES, STUDENTS, XLA_LOSSES
 import numpy as np
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
@@ -67,11 +75,18 @@ def parse_args():
 
     parser.add_argument(
         "--mode",
-        help="'train_test' or 'eval' options, see train_test.py module",
+        help="'train_test', 'eval', 'compile', 'train_head', 'export', 'channel_prune', 'quantize', 'distill', 'serve' or 'load_test' options, see train_test.py, preprocessing.py, feature_cache.py, serving.py, channel_pruning.py, quantization.py, distillation.py & inference_server.py modules",
         default="train_test",
         type=str,
     )
 
+    parser.add_argument(
+        "--model_path",
+        help="Path of the saved model for the eval & export modes",
+        default="/root/Master-Thesis/code/model_data/1_Xception_CORAL_0.5_Original/20210306-172240/model",
+        type=str,
+    )
+
     parser.add_argument(
         "--loss_function",
         help="Select domain alignment loss function, see loss.py module",
@@ -92,18 +107,238 @@ def parse_args():
         action="store_true",
     )
 
+    parser.add_argument(
+        "--use_cache",  # Default set is false
+        help="To stream the compiled TFRecord shards instead of decoding the images every epoch",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--cache_in_memory",  # Default set is false
+        help="To keep the decoded SynSigns images in RAM after the first epoch",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--sampler",
+        help="'repeat' balances the domains by repeating the smaller one, 'infinite' draws both from independent infinite streams, see preprocessing.py module",
+        default="repeat",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--steps_per_epoch",
+        help="Steps per epoch of the infinite sampler, 0 takes the batch count of the larger domain",
+        default=0,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--source_ratio",
+        help="Source:target images ratio per step of the infinite sampler",
+        default=1.0,
+        type=float,
+    )
+
+    parser.add_argument(
+        "--seed",
+        help="Shuffling seed of the infinite sampler",
+        default=None,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--precision",
+        help="'float32', 'mixed_bfloat16' (TPUs only, TF 2.3 has no bfloat16 gradient kernels for CPUs & GPUs) or 'mixed_float16' (GPUs) precision of the backbones",
+        default="float32",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--train_loop",
+        help="'fit' trains with model.fit, 'custom' with the explicit loop of train_test.py",
+        default="fit",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--jit_compile",  # Default set is false
+        help="To XLA compile the training & validation steps of the custom loop, with the losses of config.XLA_LOSSES",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--accum_steps",
+        help="Micro-batches of batch_size accumulated per step, the domain loss uses the features of all of them. Uses the custom training loop",
+        default=1,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--align_layers",
+        help="Comma separated Xception layers also aligned by the domain loss, e.g. 'block4_sepconv2_bn,block13_sepconv2_bn', none if empty",
+        default="",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--sketch_dim",
+        help="Random projection size of the pooled aligned layers, 0 keeps all channels",
+        default=64,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--val_mode",
+        help="'full' validates the whole model every epoch, 'branch' only the prediction branch, see utils.BranchValidation",
+        default="full",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--val_freq",
+        help="Epochs between the validations of the branch mode, the first & last epochs are always validated",
+        default=1,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--val_subset",
+        help="Stratified fraction of the target images validated in the branch mode, read from the compiled shards with use_cache, the whole set is evaluated after the training",
+        default=1.0,
+        type=float,
+    )
+
+    parser.add_argument(
+        "--prune_levels",
+        help="Comma separated fractions of the channels removed by the channel_prune mode",
+        default="0.1,0.25,0.5",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--prune_criterion",
+        help="'magnitude' (L1 norm of the filters) or 'bn_scale' (BatchNorm gamma) channel importance of the channel_prune mode",
+        default="magnitude",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--finetune_epochs",
+        help="Source domain fine-tuning epochs of every channel pruned model, 0 for none",
+        default=0,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--calibration_samples",
+        help="Target images calibrating the int8 activation ranges of the quantize mode",
+        default=200,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--students",
+        help="Comma separated students of the distill mode, 'mobilenetv2_<0.35, 0.5, 0.75, 1.0, 1.3 or 1.4>' or 'alexnet'",
+        default="mobilenetv2_0.35,mobilenetv2_0.5,mobilenetv2_1.0,alexnet",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--temperature",
+        help="Softmax temperature of the distillation loss",
+        default=4.0,
+        type=float,
+    )
+
+    parser.add_argument(
+        "--distill_alpha",
+        help="Weight of the source classification loss of the students, the distillation loss gets 1 - distill_alpha",
+        default=0.5,
+        type=float,
+    )
+
+    parser.add_argument(
+        "--host",
+        help="Host of the inference server",
+        default="127.0.0.1",
+        type=str,
+    )
+
+    parser.add_argument("--port", default=8500, help="Inference server port", type=int)
+
+    parser.add_argument(
+        "--max_batch_latency_ms",
+        help="Longest wait of a request of the inference server for its batch to fill up",
+        default=10.0,
+        type=float,
+    )
+
+    parser.add_argument(
+        "--num_workers",
+        help="JPEG decoding & preprocessing threads of the inference server",
+        default=4,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        help="Concurrent clients of the load_test mode",
+        default=16,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--num_requests",
+        help="Requests sent by the load_test mode",
+        default=1000,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--save_probabilities",  # Default set is false
+        help="To write the labels, predictions & probabilities of the eval mode to memory-mapped .npy files",
+        action="store_true",
+    )
+
     parser.add_argument(
         "--technique",  # Default set is false
         help="Choose techniques, MBM - if false, CDAN - if frue",
         action="store_true",
     )
 
+    parser.add_argument(
+        "--shared_backbone",  # Default set is false
+        help="CDAN with one Xception whose convolutions are shared by both domains, with domain-specific BatchNorm layers",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--adapter_dim",
+        help="Bottleneck size of the residual adapter on the target features of the shared backbone CDAN, 0 for none",
+        default=0,
+        type=int,
+    )
+
     parser.add_argument(
         "--prune",  # Default set is false
         help="Shared FE will be optimized if MBM, otherwise Target FE will be optimized if CDAN",
         action="store_true",
     )
 
+    parser.add_argument(
+        "--qat",  # Default set is false
+        help="After the pruning training, quantization aware training of the pruned feature extractor & int8 TFLite export, see qat.py module",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--qat_epochs",
+        help="Epochs of the quantization aware training",
+        default=2,
+        type=int,
+    )
+
     parser.add_argument(
         "--epochs", default=4, help="Epochs to run a particular scenario", type=int
     )
@@ -142,17 +377,122 @@ def main():
     assert params["mode"] in [
         "train_test",
         "eval",
-    ], "The mode must be train_test or eval"
+        "compile",
+        "train_head",
+        "export",
+        "channel_prune",
+        "quantize",
+        "distill",
+        "serve",
+        "load_test",
+    ], "The mode must be train_test, eval, compile, train_head, export, channel_prune, quantize, distill, serve or load_test"
+
+    assert params["sampler"] in [
+        "repeat",
+        "infinite",
+    ], "The sampler must be repeat or infinite"
+
+    assert params["precision"] in [
+        "float32",
+        "mixed_bfloat16",
+        "mixed_float16",
+    ], "The precision must be float32, mixed_bfloat16 or mixed_float16"
+
+    # TF 2.3 has no bfloat16 kernels of e.g. Reciprocal for CPUs, the gradient of
+    # the bfloat16 GlobalAveragePooling fails
+    assert params["precision"] != "mixed_bfloat16" or tf.config.list_logical_devices(
+        "TPU"
+    ), "mixed_bfloat16 needs a TPU with the pinned TF 2.3, use mixed_float16 on GPUs"
+
+    assert params["train_loop"] in [
+        "fit",
+        "custom",
+    ], "The train_loop must be fit or custom"
+
+    assert not params["qat"] or (
+        params["prune"] and params["precision"] == "float32"
+    ), "qat fine-tunes a pruned float32 model, add prune & use float32 precision"
+
+    assert not (
+        params["qat"] and params["use_multiGPU"]
+    ), "The quantization aware training runs on a single device"
+
+    assert params["prune_criterion"] in [
+        "magnitude",
+        "bn_scale",
+    ], "The prune_criterion must be magnitude or bn_scale"
+
+    assert params["val_mode"] in [
+        "full",
+        "branch",
+    ], "The val_mode must be full or branch"
+
+    assert params["val_mode"] == "branch" or (
+        params["val_freq"] == 1 and params["val_subset"] == 1
+    ), "val_freq & val_subset need the branch val_mode"
+
+    assert not (
+        (params["train_loop"] == "custom" or params["accum_steps"] > 1)
+        and params["use_multiGPU"]
+    ), "The custom training loop runs on a single device"
+
+    assert not params["jit_compile"] or (
+        params["loss_function"] in XLA_LOSSES
+    ), "jit_compile supports the loss functions " + ", ".join(XLA_LOSSES)
+
+    assert (
+        params["technique"] or not params["shared_backbone"]
+    ), "shared_backbone is a CDAN option, add technique"
+
+    assert (
+        params["shared_backbone"] or not params["adapter_dim"]
+    ), "adapter_dim is an option of the shared backbone CDAN, add shared_backbone"
+
+    assert not (
+        params["shared_backbone"] and params["prune"]
+    ), "Pruning the shared convolutions would prune the source branch too"
+
+    assert not (
+        params["align_layers"] and params["loss_function"] in STATEFUL_LOSSES
+    ), "Stateful domain losses align the pooled features only, drop align_layers"
+
+    assert params["mode"] != "distill" or all(
+        student in STUDENTS for student in params["students"].split(",")
+    ), "The students must be in " + ", ".join(STUDENTS)
 
     if params["mode"] == "train_test":
         model, hist, results = train_test(params)
 
     elif params["mode"] == "eval":
         evaluate(
-            model_path="/root/Master-Thesis/code/model_data/1_Xception_CORAL_0.5_Original/20210306-172240/model",
+            model_path=params["model_path"],
             params=params,
         )
 
+    elif params["mode"] == "compile":
+        compile_data(params)
+
+    elif params["mode"] == "train_head":
+        model, hist, results = train_head(params)
+
+    elif params["mode"] == "export":
+        export(model_path=params["model_path"], params=params)
+
+    elif params["mode"] == "channel_prune":
+        channel_prune(model_path=params["model_path"], params=params)
+
+    elif params["mode"] == "quantize":
+        quantize(model_path=params["model_path"], params=params)
+
+    elif params["mode"] == "distill":
+        distill(model_path=params["model_path"], params=params)
+
+    elif params["mode"] == "serve":
+        serve(model_path=params["model_path"], params=params)
+
+    elif params["mode"] == "load_test":
+        load_test(params)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,213 @@
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras import layers
+import os
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import modules.config as cn
+import modules.utils as utils
+from modules.preprocessing import fetch_validation_data, load_manifest, read_domain
+from modules.serving import build_serving_model, export_serving_model
+
+
+def prunable_chains(backbone):
+    """[This method finds the SeparableConv2D layers of the backbone whose output
+    channels can be removed: the ones followed only by BatchNormalization ->
+    Activation -> SeparableConv2D, i.e. the first separable convolutions of the
+    Xception blocks & the second ones of the middle flow. The outputs of the
+    convolutions which feed a residual Add keep their channels.]
+
+    Args:
+        backbone ([keras model]): [single output backbone]
+
+    Returns:
+        [list]: [(separable conv, batch norm, next separable conv) layer names]
+    """
+    config = backbone.get_config()
+    classes = {layer["name"]: layer["class_name"] for layer in config["layers"]}
+    outputs = {output[0] for output in config["output_layers"]}
+    consumers = {}
+    for layer in config["layers"]:
+        for node in layer["inbound_nodes"]:
+            for inbound in node:
+                consumers.setdefault(inbound[0], []).append(layer["name"])
+
+    def only_consumer(name, class_name):
+        following = consumers.get(name, [])
+        if len(following) == 1 and classes[following[0]] == class_name:
+            if name not in outputs:
+                return following[0]
+        return None
+
+    chains = []
+    for name, class_name in classes.items():
+        if class_name != "SeparableConv2D":
+            continue
+        bn = only_consumer(name, "BatchNormalization")
+        activation = bn and only_consumer(bn, "Activation")
+        next_conv = activation and only_consumer(activation, "SeparableConv2D")
+        if next_conv:
+            chains.append((name, bn, next_conv))
+
+    return chains
+
+
+def channel_scores(backbone, chain, criterion):
+    """[Importance of the output channels of a separable convolution, the L1 norm
+    of their pointwise filters (magnitude) or the |gamma| of the following
+    BatchNormalization (bn_scale).]"""
+    conv, bn, _ = chain
+    if criterion == "bn_scale":
+        return np.abs(backbone.get_layer(bn).gamma.numpy())
+    pointwise = backbone.get_layer(conv).pointwise_kernel.numpy()
+    return np.abs(pointwise).sum(axis=(0, 1, 2))
+
+
+def prune_channels(backbone, level, criterion="magnitude"):
+    """[This method removes the least important output channels of every prunable
+    separable convolution, see prunable_chains. The backbone is rebuilt from its
+    config with fewer filters and the kept slices of the weights are copied, so
+    the result is a smaller dense model.]
+
+    Args:
+        backbone ([keras model]): [single output backbone]
+        level ([float]): [fraction of the channels removed per layer]
+        criterion (str, optional): ['magnitude' or 'bn_scale']. Defaults to "magnitude".
+
+    Returns:
+        [keras model]: [pruned backbone]
+    """
+    keep_out, keep_in, bn_keep = {}, {}, {}
+    for chain in prunable_chains(backbone):
+        conv, bn, next_conv = chain
+        scores = channel_scores(backbone, chain, criterion)
+        num_kept = max(1, int(round((1 - level) * len(scores))))
+        keep = np.sort(np.argsort(-scores)[:num_kept])
+        keep_out[conv], bn_keep[bn], keep_in[next_conv] = keep, keep, keep
+
+    config = backbone.get_config()
+    for layer in config["layers"]:
+        if layer["name"] in keep_out:
+            layer["config"]["filters"] = len(keep_out[layer["name"]])
+    pruned = keras.Model.from_config(config)
+
+    for layer in pruned.layers:
+        weights = backbone.get_layer(layer.name).get_weights()
+        if layer.name in keep_in:
+            # Depthwise & pointwise kernels along their input channels
+            weights[0] = weights[0][:, :, keep_in[layer.name], :]
+            weights[1] = weights[1][:, :, keep_in[layer.name], :]
+        if layer.name in keep_out:
+            weights[1] = weights[1][..., keep_out[layer.name]]
+            if len(weights) > 2:
+                weights[2] = weights[2][keep_out[layer.name]]
+        if layer.name in bn_keep:
+            weights = [weight[bn_keep[layer.name]] for weight in weights]
+        layer.set_weights(weights)
+
+    return pruned
+
+
+def pruned_serving_model(serving_model, level, criterion="magnitude"):
+    """[This method prunes the backbone of a serving model, see build_serving_model,
+    and puts a copy of its prediction head on top of it.]"""
+    backbone = [
+        layer for layer in serving_model.layers if isinstance(layer, keras.Model)
+    ][0]
+    # The aligned layers outputs are not used for the prediction
+    backbone = keras.Model(backbone.inputs, backbone.outputs[0], name=backbone.name)
+    backbone = prune_channels(backbone, level, criterion)
+
+    prediction = serving_model.get_layer("prediction")
+    inputs = keras.Input(serving_model.input_shape[1:])
+    features = layers.Activation("linear", dtype="float32")(backbone(inputs))
+    head = layers.Dense(prediction.units, name="prediction", dtype="float32")
+    model = keras.Model(inputs, head(features), name="pruned_serving_model")
+    head.set_weights(prediction.get_weights())
+
+    return model
+
+
+def channel_prune(model_path, params):
+    """[This method prunes the channels of the serving model of a saved get_model
+    model at every level of prune_levels. Every pruned model is optionally fine-
+    tuned on the labelled source domain, exported as a fixed batch SavedModel
+    and reported with its parameters, gzipped size, CPU latency & target accuracy.]
+
+    Args:
+        model_path ([str]): [path of the trained keras model]
+        params ([dict]): [Argparse dictionary]
+
+    Returns:
+        [pandas DataFrame]: [report of every pruning level]
+    """
+    output_dir = os.path.join(Path(model_path).parent, "channel_pruning")
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    utils.define_logger(os.path.join(output_dir, "channel_pruning.log"))
+
+    tf.compat.v1.logging.info("Loading the trained model ...")
+    model = keras.models.load_model(model_path, custom_objects=cn.CUSTOM_OBJECTS)
+    serving_model = build_serving_model(model)
+
+    source_domain, _ = cn.DOMAIN_PAIRS[cn.DATASET_COMBINATION[params["combination"]]]
+    ds_val = fetch_validation_data(params)
+    images = tf.random.uniform(
+        [params["batch_size"], *params["input_shape"]], -1.0, 1.0
+    )
+
+    levels = [0.0] + [float(level) for level in params["prune_levels"].split(",")]
+    report = []
+    for level in levels:
+        tf.compat.v1.logging.info(
+            f"Pruning {100 * level:.0f}% of the channels by {params['prune_criterion']}"
+        )
+        pruned = (
+            pruned_serving_model(serving_model, level, params["prune_criterion"])
+            if level
+            else serving_model
+        )
+        pruned.compile(
+            optimizer=keras.optimizers.Adam(learning_rate=params["learning_rate"]),
+            loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+            metrics=["accuracy"],
+        )
+
+        if level and params["finetune_epochs"]:
+            # Classification loss only, the target domain has no labels
+            tf.compat.v1.logging.info("Fine-tuning on the source domain ...")
+            pruned.fit(
+                read_domain(source_domain, load_manifest(source_domain), params),
+                epochs=params["finetune_epochs"],
+                verbose=1,
+            )
+
+        _, accuracy = pruned.evaluate(ds_val, verbose=0)
+        latency = utils.measure_latency(tf.function(pruned), images)
+        report.append(
+            {
+                "level": level,
+                "num_params": pruned.count_params(),
+                "gzipped_size_mb": utils.get_gzipped_model_size(pruned) / (1024 ** 2),
+                "p50_ms": latency["p50_ms"],
+                "p99_ms": latency["p99_ms"],
+                "accuracy": accuracy,
+            }
+        )
+        tf.compat.v1.logging.info(str(report[-1]))
+
+        export_serving_model(
+            pruned,
+            os.path.join(output_dir, f"pruned_{level}"),
+            params["batch_size"],
+            params["input_shape"],
+        )
+
+    report = pd.DataFrame(report)
+    report.to_csv(os.path.join(output_dir, "report.csv"), index=False)
+    with open(os.path.join(output_dir, "params.json"), "w") as f:
+        json.dump(params, f, indent=2, default=str)
+    tf.compat.v1.logging.info("Channel pruning report:\n" + report.to_string())
+
+    return report
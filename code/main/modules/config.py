@@ -1,6 +1,6 @@
 import tensorflow as tf
 from pathlib import Path
-from modules.loss import CORAL, coral_loss
+from modules.loss import CORAL, running_coral, RunningCORAL, log_coral_loss, mmd_loss
 
 initializer = tf.keras.initializers.he_normal()  # Layer initializations
 
@@ -11,6 +11,10 @@ GTSRB_PATH = Path("/root/Master-Thesis/code/data/GTSRB/")  # GTSRB dataset path
 LOGS_DIR = BASE_DIR / Path("logs/")  # Logs path
 MODEL_PATH = BASE_DIR / Path("model_data/")  # Model path
 EVALUATION = BASE_DIR / Path("evaluation/")  # Evalaution plots path
+CACHE_DIR = BASE_DIR / Path("data/cache/")  # Compiled TFRecord shards path
+MANIFEST_DIR = CACHE_DIR / Path("manifests/")  # Domain manifests path
+FEATURES_DIR = CACHE_DIR / Path("features/")  # Frozen backbone features path
+NUM_SHARDS = 16  # TFRecord shards written per compiled domain
 AUTOTUNE = tf.data.experimental.AUTOTUNE
 DATASET_COMBINATION = {
     # This dictionary shows various domain adaptation scenarios.
@@ -21,8 +25,46 @@ DATASET_COMBINATION = {
     "SynSigns_to_GTSRB": 5,
 }
 
+DOMAINS = {
+    # This dictionary maps every domain to its image directory.
+    "amazon": OFFICE_DS_PATH / "amazon",
+    "webcam": OFFICE_DS_PATH / "webcam",
+    "dslr": OFFICE_DS_PATH / "dslr",
+    "synsigns": SYNTHETIC_PATH,
+    "gtsrb": GTSRB_PATH / "train",
+}
+
+# Source & target domains of every domain adaptation scenario.
+DOMAIN_PAIRS = {
+    1: ("amazon", "webcam"),
+    2: ("amazon", "dslr"),
+    3: ("webcam", "amazon"),
+    4: ("dslr", "amazon"),
+    5: ("synsigns", "gtsrb"),
+}
+
 # It highlights the bacbone model available for training.
 ARCHITECTURE = {"Xception": 1, "Other": 2}
 
 # This dictionary allows to select different domain alignment loss functions.
-LOSS = {"CORAL": CORAL, "Another": coral_loss}
+LOSS = {
+    "CORAL": CORAL,
+    "CORAL_EMA": running_coral,
+    "LogCORAL": log_coral_loss,
+    "MMD": mmd_loss,
+}
+
+# Losses holding state across the steps, they can only be built once into a model
+STATEFUL_LOSSES = ["CORAL_EMA"]
+
+# Losses whose ops all have XLA kernels, the ones allowed with jit_compile. A loss
+# drawing random numbers at every step, e.g. stateless_normal, has none on XLA_CPU
+XLA_LOSSES = ["CORAL", "CORAL_EMA", "LogCORAL", "MMD"]
+
+# Distillation students, MobileNetV2 has ImageNet weights only at these widths
+STUDENTS = ["alexnet"] + [
+    f"mobilenetv2_{alpha}" for alpha in (0.35, 0.5, 0.75, 1.0, 1.3, 1.4)
+]
+
+# Custom layers needed to load the saved models
+CUSTOM_OBJECTS = {"RunningCORAL": RunningCORAL}
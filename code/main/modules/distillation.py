@@ -0,0 +1,195 @@
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras import layers
+import os
+import pandas as pd
+from pathlib import Path
+import modules.config as cn
+import modules.utils as utils
+from modules.models import AlexNet
+from modules.preprocessing import fetch_data, fetch_validation_data, train_steps
+from modules.serving import build_serving_model, export_serving_model
+
+
+class Distiller(keras.Model):
+    """[This model trains a student on the logits of a frozen teacher. Every batch
+    holds labelled source & unlabelled target images: the student learns the
+    softened teacher predictions of both, and the source labels.]
+
+    Args:
+        student ([keras model]): [single input student returning the logits]
+        teacher ([keras model]): [single input teacher returning the logits]
+        temperature (float, optional): [softmax temperature]. Defaults to 4.0.
+        alpha (float, optional): [weight of the source classification loss, the
+        distillation loss gets 1 - alpha]. Defaults to 0.5.
+    """
+
+    def __init__(self, student, teacher, temperature=4.0, alpha=0.5):
+        super().__init__()
+        self.student = student
+        self.teacher = teacher
+        self.temperature = temperature
+        self.alpha = alpha
+        self.classification_loss = tf.keras.losses.SparseCategoricalCrossentropy(
+            from_logits=True
+        )
+        self.distillation_loss = tf.keras.losses.KLDivergence()
+
+    def call(self, inputs, training=False):
+        return self.student(inputs, training=training)
+
+    def train_step(self, data):
+        (source, target), labels = data
+        images = tf.concat([source, target], 0)
+        num_source = tf.shape(source)[0]
+        teacher_logits = self.teacher(images, training=False)
+
+        with tf.GradientTape() as tape:
+            student_logits = self.student(images, training=True)
+            classification_loss = self.classification_loss(
+                labels, student_logits[:num_source]
+            )
+            # Scaled by T², the gradients keep their magnitude across temperatures
+            distillation_loss = self.distillation_loss(
+                tf.nn.softmax(teacher_logits / self.temperature),
+                tf.nn.softmax(student_logits / self.temperature),
+            ) * (self.temperature ** 2)
+            loss = (
+                self.alpha * classification_loss + (1 - self.alpha) * distillation_loss
+            )
+
+        gradients = tape.gradient(loss, self.student.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.student.trainable_variables))
+
+        self.compiled_metrics.update_state(labels, student_logits[:num_source])
+        logs = {metric.name: metric.result() for metric in self.metrics}
+        logs.update({"loss": loss, "distillation_loss": distillation_loss})
+        return logs
+
+    def test_step(self, data):
+        images, labels = data
+        student_logits = self.student(images, training=False)
+        self.compiled_metrics.update_state(labels, student_logits)
+        logs = {metric.name: metric.result() for metric in self.metrics}
+        logs["loss"] = self.classification_loss(labels, student_logits)
+        return logs
+
+
+def get_student(name, input_shape, num_classes):
+    """[This method builds a student network with a linear prediction head.
+
+    Args:
+        name ([str]): [one of config.STUDENTS, 'mobilenetv2_<width multiplier>',
+        e.g. 'mobilenetv2_0.35', or 'alexnet']
+        input_shape ([tuple]): [input shape of the teacher]
+        num_classes ([int]): [number of classes]
+
+    Returns:
+        [keras model]: [student returning the logits]
+    """
+    if name not in cn.STUDENTS:
+        raise ValueError(f"Unknown student {name}, use one of {cn.STUDENTS}")
+
+    inputs = tf.keras.Input(input_shape)
+
+    if name.startswith("mobilenetv2"):
+        # The inputs are already scaled to [-1, 1] by preprocess, as MobileNetV2
+        # expects
+        backbone = tf.keras.applications.MobileNetV2(
+            include_top=False,
+            weights="imagenet",
+            pooling="avg",
+            input_shape=input_shape,
+            alpha=float(name.split("_")[1]),
+        )
+        features = backbone(inputs)
+    else:
+        backbone = AlexNet(img_shape=input_shape, num_classes=num_classes, weights=None)
+        features = backbone(inputs)
+
+    logits = layers.Dense(
+        num_classes, kernel_initializer=cn.initializer, name="prediction"
+    )(features)
+
+    return keras.Model(inputs, logits, name=name.replace(".", ""))
+
+
+def distill(model_path, params):
+    """[This method distills the prediction branch of a saved get_model model into
+    every student of the students list, on the training batches of fetch_data.
+    Every student is exported as a fixed batch SavedModel and reported with its
+    parameters, gzipped size, latency & target accuracy, next to the teacher.]
+
+    Args:
+        model_path ([str]): [path of the trained keras model, the teacher]
+        params ([dict]): [Argparse dictionary]
+
+    Returns:
+        [pandas DataFrame]: [report of the teacher & the students]
+    """
+    output_dir = os.path.join(Path(model_path).parent, "distillation")
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    utils.define_logger(os.path.join(output_dir, "distillation.log"))
+
+    tf.compat.v1.logging.info("Loading the teacher model ...")
+    teacher = build_serving_model(
+        keras.models.load_model(model_path, custom_objects=cn.CUSTOM_OBJECTS)
+    )
+    teacher.trainable = False
+
+    ds_train, _ = fetch_data(params)
+    ds_val = fetch_validation_data(params)
+    images = tf.random.uniform(
+        [params["batch_size"], *params["input_shape"]], -1.0, 1.0
+    )
+
+    def report_row(name, model):
+        model.compile(
+            loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+            metrics=["accuracy"],
+        )
+        _, accuracy = model.evaluate(ds_val, verbose=0)
+        latency = utils.measure_latency(tf.function(model), images)
+        row = {
+            "model": name,
+            "num_params": model.count_params(),
+            "gzipped_size_mb": utils.get_gzipped_model_size(model) / (1024 ** 2),
+            "p50_ms": latency["p50_ms"],
+            "p99_ms": latency["p99_ms"],
+            "accuracy": accuracy,
+        }
+        tf.compat.v1.logging.info(str(row))
+        return row
+
+    report = [report_row("teacher", teacher)]
+    for name in params["students"].split(","):
+        tf.compat.v1.logging.info(f"Distilling the teacher into {name} ...")
+        student = get_student(name, params["input_shape"], params["output_classes"])
+        distiller = Distiller(
+            student, teacher, params["temperature"], params["distill_alpha"]
+        )
+        distiller.compile(
+            optimizer=keras.optimizers.Adam(learning_rate=params["learning_rate"]),
+            metrics=["accuracy"],
+        )
+        distiller.fit(
+            ds_train,
+            validation_data=ds_val,
+            epochs=params["epochs"],
+            steps_per_epoch=train_steps(params),
+            verbose=1,
+        )
+
+        report.append(report_row(name, student))
+        export_serving_model(
+            student,
+            os.path.join(output_dir, name),
+            params["batch_size"],
+            params["input_shape"],
+        )
+
+    report = pd.DataFrame(report)
+    report.to_csv(os.path.join(output_dir, "report.csv"), index=False)
+    tf.compat.v1.logging.info("Distillation report:\n" + report.to_string())
+
+    return report
@@ -0,0 +1,198 @@
+import tensorflow as tf
+from tensorflow import keras
+import os
+import math
+import numpy as np
+from pathlib import Path
+import modules.config as cn
+import modules.utils as utils
+from modules.models import get_head_model
+from modules.preprocessing import load_manifest, read_domain, read_compiled_domain
+
+
+def extract_features(domain, params):
+    """[This method runs the frozen ImageNet backbone once over a domain and stores
+    its pooled features & labels as memory-mapped .npy files. Nothing is computed if
+    the store already exists.]
+
+    Args:
+        domain ([str]): [domain name, see config.DOMAINS]
+        params ([dict]): [Argparse dictionary]
+
+    Returns:
+        [tuple]: [memory-mapped features, labels]
+    """
+    store = cn.FEATURES_DIR / f"{domain}_{params['resize']}_{params['architecture']}"
+    features_path = store / "features.npy"
+    labels_path = store / "labels.npy"
+
+    if not features_path.exists():
+        tf.compat.v1.logging.info(f"Extracting the backbone features of {domain} ...")
+        Path(store).mkdir(parents=True, exist_ok=True)
+
+        backbone = tf.keras.applications.Xception(
+            include_top=False,
+            weights="imagenet",
+            pooling="avg",
+            input_shape=params["input_shape"],
+        )
+
+        manifest = load_manifest(domain)
+        if params["use_cache"]:
+            ds = read_compiled_domain(domain, params, shuffle=False)
+        else:
+            ds = read_domain(domain, manifest, params)
+
+        # Written to a temporary file first, the final name marks a complete store
+        tmp_path = store / "features.tmp.npy"
+        features = np.lib.format.open_memmap(
+            str(tmp_path),
+            mode="w+",
+            dtype=np.float32,
+            shape=(manifest["num_images"], backbone.output_shape[-1]),
+        )
+        labels = np.zeros(manifest["num_images"], dtype=np.int64)
+
+        offset = 0
+        for images, batch_labels in ds.prefetch(cn.AUTOTUNE):
+            batch_features = backbone(images, training=False).numpy()
+            features[offset : offset + len(batch_features)] = batch_features
+            labels[offset : offset + len(batch_features)] = batch_labels.numpy()
+            offset += len(batch_features)
+
+        features.flush()
+        del features
+        np.save(labels_path, labels)
+        os.replace(tmp_path, features_path)
+        tf.compat.v1.logging.info(f"Features of {offset} images saved at {store}")
+
+    return np.load(features_path, mmap_mode="r"), np.load(labels_path)
+
+
+def index_batches(num_images, batch_size, rng):
+    """[Endless sorted index batches over successive random permutations, sorted
+    indices keep the memory-mapped reads sequential.]"""
+    while True:
+        permutation = rng.permutation(num_images)
+        for i in range(0, num_images - batch_size + 1, batch_size):
+            yield np.sort(permutation[i : i + batch_size])
+
+
+def feature_datasets(source, target, params):
+    """[This method builds the training & test datasets on top of the feature
+    stores, in the same ((source, target), label) layout as fetch_data.]"""
+    source_features, source_labels = source
+    target_features, target_labels = target
+    feature_dim = source_features.shape[1]
+    batch_size = params["batch_size"]
+
+    def train_generator():
+        rng = np.random.default_rng(params["seed"])
+        source_batches = index_batches(len(source_features), batch_size, rng)
+        target_batches = index_batches(len(target_features), batch_size, rng)
+        for source_idx, target_idx in zip(source_batches, target_batches):
+            yield (source_features[source_idx], target_features[target_idx]), (
+                source_labels[source_idx].astype(np.float32)
+            )
+
+    def test_generator():
+        for i in range(0, len(target_features), batch_size):
+            batch = np.asarray(target_features[i : i + batch_size])
+            yield (batch, batch), target_labels[i : i + batch_size].astype(np.float32)
+
+    output_types = ((tf.float32, tf.float32), tf.float32)
+    output_shapes = (
+        (
+            tf.TensorShape([None, feature_dim]),
+            tf.TensorShape([None, feature_dim]),
+        ),
+        tf.TensorShape([None]),
+    )
+    ds_train = tf.data.Dataset.from_generator(
+        train_generator, output_types, output_shapes
+    ).prefetch(cn.AUTOTUNE)
+    ds_test = tf.data.Dataset.from_generator(
+        test_generator, output_types, output_shapes
+    ).prefetch(cn.AUTOTUNE)
+
+    return ds_train, ds_test
+
+
+def train_head(params):
+    """[This method trains the prediction head & the domain alignment loss on top of
+    the frozen ImageNet backbone features, which are computed only once per domain.
+    The loss aligns the source & target logits of the head, see get_head_model.]
+    """
+
+    # Create directory for unique logs
+    my_dir = (
+        str(cn.DATASET_COMBINATION[params["combination"]])
+        + "_"
+        + str(params["architecture"])
+        + "_"
+        + str(params["loss_function"])
+        + "_"
+        + str(params["lambda_loss"])
+        + "_FrozenBackbone"
+    )
+
+    assert os.path.exists(cn.LOGS_DIR), "LOGS_DIR doesn't exist"
+    experiment_logs_path = os.path.join(cn.LOGS_DIR, my_dir)
+    Path(experiment_logs_path).mkdir(parents=True, exist_ok=True)
+    utils.define_logger(os.path.join(experiment_logs_path, "experiments.log"))
+    tf.compat.v1.logging.info("\n")
+    tf.compat.v1.logging.info("Parameters: " + str(params))
+
+    source_domain, target_domain = cn.DOMAIN_PAIRS[
+        cn.DATASET_COMBINATION[params["combination"]]
+    ]
+    source = extract_features(source_domain, params)
+    target = extract_features(target_domain, params)
+    ds_train, ds_test = feature_datasets(source, target, params)
+
+    steps_per_epoch = params["steps_per_epoch"] or max(
+        math.ceil(len(source[1]) / params["batch_size"]),
+        math.ceil(len(target[1]) / params["batch_size"]),
+    )
+
+    tf.compat.v1.logging.info("Building the head model ...")
+    model = get_head_model(
+        feature_dim=source[0].shape[1],
+        num_classes=params["output_classes"],
+        lambda_loss=params["lambda_loss"],
+        additional_loss=params["loss_function"],
+    )
+    model.compile(
+        optimizer=keras.optimizers.Adam(learning_rate=params["learning_rate"]),
+        loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+        metrics=["accuracy"],
+    )
+
+    callbacks, log_dir = utils.callbacks_fn(params, my_dir)
+
+    tf.compat.v1.logging.info("Training Started....")
+    hist = model.fit(
+        ds_train,
+        validation_data=ds_test,
+        epochs=params["epochs"],
+        steps_per_epoch=steps_per_epoch,
+        verbose=1,
+        callbacks=callbacks,
+    )
+    tf.compat.v1.logging.info("Training finished....")
+
+    results = model.evaluate(ds_test)
+    tf.compat.v1.logging.info(
+        f"Test Set evaluation results for run {Path(log_dir).name} : Accuracy: {results[1]}, Loss: {results[0]}"
+    )
+
+    if params["save_model"]:
+        tf.compat.v1.logging.info("Saving the head model...")
+        model_path = os.path.join(
+            cn.MODEL_PATH, (Path(log_dir).parent).name, Path(log_dir).name
+        )
+        Path(model_path).mkdir(parents=True, exist_ok=True)
+        model.save(os.path.join(model_path, "head_model"))
+        tf.compat.v1.logging.info(f"Head model successfully saved at: {model_path}")
+
+    return model, hist, results
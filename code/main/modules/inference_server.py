@@ -0,0 +1,293 @@
+import tensorflow as tf
+import os
+import json
+import time
+import queue
+import datetime
+import threading
+import collections
+import urllib.request
+import numpy as np
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import modules.config as cn
+from modules.preprocessing import decode_at_size, load_manifest
+
+
+def decode_request(contents, new_size):
+    """[Decodes, resizes & preprocesses the JPEG bytes of a request the same way as
+    the training images.]"""
+    image = decode_at_size(tf.constant(contents), new_size)
+    image = tf.image.resize(image, [new_size, new_size])
+    image = tf.keras.applications.xception.preprocess_input(image)
+
+    return image.numpy()
+
+
+class LatencyMetrics:
+    """[Thread safe request counter & latencies of the last window requests, so the
+    memory stays constant however long the server runs.]"""
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.start = time.perf_counter()
+
+    def record(self, latency_ms):
+        with self.lock:
+            self.latencies.append(latency_ms)
+            self.requests += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            requests = self.requests
+        return {
+            "requests": requests,
+            "throughput_rps": requests / (time.perf_counter() - self.start),
+            "p50_ms": float(np.percentile(latencies, 50)) if latencies else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if latencies else None,
+        }
+
+
+class DynamicBatcher:
+    """[This class groups concurrent single image requests into batches for the
+    fixed batch serving signature. A batch is run as soon as it is full or
+    max_latency_ms after its first request arrived, the missing images are
+    zero padded.]
+
+    Args:
+        predict_fn ([function]): [numpy batch -> numpy probabilities]
+        batch_size ([int]): [batch size of the serving signature]
+        max_latency_ms ([float]): [longest wait of a request for its batch]
+    """
+
+    def __init__(self, predict_fn, batch_size, max_latency_ms):
+        self.predict_fn = predict_fn
+        self.batch_size = batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_sizes = collections.deque(maxlen=10000)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, image):
+        """[Queues a preprocessed image, the future holds its probabilities.]"""
+        future = Future()
+        self.requests.put((image, future))
+        return future
+
+    def mean_batch_size(self):
+        """[Mean size of the last batches, None before the first batch.]"""
+        with self.lock:
+            batch_sizes = list(self.batch_sizes)
+        return float(np.mean(batch_sizes)) if batch_sizes else None
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_latency
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                images = np.stack([image for image, _ in batch])
+                padded = np.zeros((self.batch_size, *images.shape[1:]), np.float32)
+                padded[: len(batch)] = images
+                probabilities = self.predict_fn(padded)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), image_probabilities in zip(batch, probabilities):
+                future.set_result(image_probabilities)
+            with self.lock:
+                self.batch_sizes.append(len(batch))
+
+
+def make_handler(batcher, workers, metrics, new_size):
+    """[This method returns the request handler of the server: POST /predict with
+    the JPEG bytes as body, GET /metrics & GET /health.]"""
+
+    class InferenceHandler(BaseHTTPRequestHandler):
+        def send_json(self, body, status=200):
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                summary = metrics.summary()
+                summary["mean_batch_size"] = batcher.mean_batch_size()
+                self.send_json(summary)
+            elif self.path == "/health":
+                self.send_json({"status": "ok"})
+            else:
+                self.send_json({"error": "unknown path"}, status=404)
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self.send_json({"error": "unknown path"}, status=404)
+                return
+
+            if self.headers["Content-Length"] is None:
+                self.send_json({"error": "Content-Length required"}, status=411)
+                return
+            try:
+                content_length = int(self.headers["Content-Length"])
+            except ValueError:
+                self.send_json({"error": "invalid Content-Length"}, status=400)
+                return
+
+            start = time.perf_counter()
+            contents = self.rfile.read(content_length)
+            # Undecodable images are client errors, failed predictions server ones
+            try:
+                image = workers.submit(decode_request, contents, new_size).result()
+            except Exception as e:
+                self.send_json({"error": str(e)}, status=400)
+                return
+            try:
+                probabilities = batcher.submit(image).result()
+            except Exception as e:
+                self.send_json({"error": str(e)}, status=500)
+                return
+            metrics.record(1000 * (time.perf_counter() - start))
+
+            self.send_json(
+                {
+                    "class": int(np.argmax(probabilities)),
+                    "probabilities": probabilities.tolist(),
+                }
+            )
+
+        def log_message(self, format, *args):
+            # Per request access logs would dominate the logs & the latency
+            pass
+
+    return InferenceHandler
+
+
+def serve(model_path, params):
+    """[This method serves the exported serving model, see serving.py, on
+    host:port. The JPEG decoding & preprocessing of the requests runs in a pool of
+    num_workers threads, the predictions in dynamic batches of up to batch_size.]
+
+    Args:
+        model_path ([str]): [path of the exported serving SavedModel]
+        params ([dict]): [Argparse dictionary]
+    """
+    tf.compat.v1.logging.info(f"Loading the serving model {model_path} ...")
+    signature = tf.saved_model.load(model_path).signatures["serving_default"]
+
+    def predict_fn(images):
+        return signature(images=tf.constant(images))["probabilities"].numpy()
+
+    batcher = DynamicBatcher(
+        predict_fn, params["batch_size"], params["max_batch_latency_ms"]
+    )
+    workers = ThreadPoolExecutor(max_workers=params["num_workers"])
+    metrics = LatencyMetrics()
+    server = ThreadingHTTPServer(
+        (params["host"], params["port"]),
+        make_handler(batcher, workers, metrics, params["resize"]),
+    )
+
+    tf.compat.v1.logging.info(
+        f"Serving on http://{params['host']}:{params['port']}/predict, batches of "
+        f"up to {params['batch_size']} within {params['max_batch_latency_ms']} ms"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        workers.shutdown()
+        tf.compat.v1.logging.info(f"Server metrics: {metrics.summary()}")
+
+
+def load_test(params):
+    """[This method sends num_requests single target images from concurrency
+    threads to a running server, and reports the client side throughput & p50/p99
+    latency with the server metrics.]
+
+    Args:
+        params ([dict]): [Argparse dictionary]
+
+    Returns:
+        [dict]: [client & server metrics]
+    """
+    url = f"http://{params['host']}:{params['port']}"
+    _, target_domain = cn.DOMAIN_PAIRS[cn.DATASET_COMBINATION[params["combination"]]]
+    files = load_manifest(target_domain)["files"]
+
+    def jpeg_bytes(file_path):
+        contents = tf.io.read_file(file_path)
+        if not file_path.lower().endswith((".jpg", ".jpeg")):
+            image = tf.image.decode_image(contents, channels=3, expand_animations=False)
+            contents = tf.io.encode_jpeg(image)
+        return contents.numpy()
+
+    requests = [
+        jpeg_bytes(files[i % len(files)]) for i in range(params["num_requests"])
+    ]
+
+    def send(contents):
+        start = time.perf_counter()
+        request = urllib.request.Request(
+            url + "/predict",
+            data=contents,
+            headers={"Content-Type": "image/jpeg"},
+        )
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        return 1000 * (time.perf_counter() - start)
+
+    tf.compat.v1.logging.info(
+        f"Sending {len(requests)} requests from {params['concurrency']} clients ..."
+    )
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=params["concurrency"]) as clients:
+        latencies = list(clients.map(send, requests))
+    seconds = time.perf_counter() - start
+
+    with urllib.request.urlopen(url + "/metrics") as response:
+        server_metrics = json.loads(response.read())
+
+    results = {
+        "client": {
+            "requests": len(latencies),
+            "throughput_rps": len(latencies) / seconds,
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+        },
+        "server": server_metrics,
+    }
+    tf.compat.v1.logging.info(f"Load test results: {results}")
+
+    output = os.path.join(
+        cn.EVALUATION,
+        "benchmarks",
+        "load_test_" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".json",
+    )
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"params": params, "results": results}, f, indent=2)
+    tf.compat.v1.logging.info(f"Load test results saved at {output}")
+
+    return results
@@ -1,4 +1,6 @@
 import tensorflow as tf
+import numpy as np
+import math
 
 
 def kl_divergence(source_output, target_output, percent_lambda):
@@ -19,69 +21,293 @@ def kl_divergence(source_output, target_output, percent_lambda):
     return kl_loss
 
 
-def CORAL(source_output, target_output, percent_lambda=0.5):
-    """[Deep CORAL loss function]
+def mmd_loss(
+    source_output,
+    target_output,
+    percent_lambda=0.5,
+    num_features=512,
+    bandwidths=(0.25, 0.5, 1.0, 2.0, 4.0),
+    seed=1337,
+):
+    """[Multi-kernel Gaussian MMD loss, approximated with random Fourier features.
+    Every kernel exp(-||x - y||² / (2 s²)) maps the features to
+    sqrt(2 / D) cos(x w / s + b), w ~ N(0, 1), b ~ U(0, 2 pi), and the squared MMD
+    is the distance between the mean source & target maps. The cost is linear in
+    the batch size & feature dimension. The bandwidths are relative to the mean
+    squared distance between the samples of the batch. The random w & b are drawn
+    once in numpy and shared by the kernels, so the loss holds no random op and
+    can be XLA compiled.]
 
     Args:
         source_output ([tf tensor]): [Source feature map tensor]
         target_output ([tf tensor]): [Target feature map tensor]
-        percent_lambda (weighting factor, optional): [CORAL loss weighting factor]. Defaults to 0.5.
+        percent_lambda (weighting factor, optional): [MMD loss weighting factor]. Defaults to 0.5.
+        num_features (int, optional): [random Fourier features per kernel]. Defaults to 512.
+        bandwidths (tuple, optional): [relative kernel bandwidths]. Defaults to (0.25, 0.5, 1.0, 2.0, 4.0).
+        seed (int, optional): [seed of the random features, fixed across steps]. Defaults to 1337.
 
     Returns:
-        [tf tensor]: [CORAL loss per batch]
+        [tf tensor]: [MMD loss per batch]
     """
-    source_batch_size = tf.cast(tf.shape(source_output)[0], tf.float32)
-    target_batch_size = tf.cast(tf.shape(target_output)[0], tf.float32)
-    d = tf.cast(tf.shape(source_output)[1], tf.float32)
+    rng = np.random.RandomState(seed)
+    w = tf.constant(rng.randn(source_output.shape[-1], num_features), tf.float32)
+    b = tf.constant(rng.uniform(0, 2 * math.pi, num_features), tf.float32)
+
+    # Mean squared distance between all pairs, 2 * mean ||x - mean||², linear time
+    features = tf.concat([source_output, target_output], 0)
+    centred = features - tf.reduce_mean(features, 0, keepdims=True)
+    scale = tf.stop_gradient(2 * tf.reduce_mean(tf.reduce_sum(tf.square(centred), 1)))
+
+    source_projection = tf.matmul(source_output, w)
+    target_projection = tf.matmul(target_output, w)
+
+    loss = 0.0
+    for bandwidth in bandwidths:
+        sigma = tf.sqrt(bandwidth * scale + 1e-8)
+
+        def random_features(projection):
+            return tf.sqrt(2.0 / num_features) * tf.cos(projection / sigma + b)
+
+        difference = tf.reduce_mean(
+            random_features(source_projection), 0
+        ) - tf.reduce_mean(random_features(target_projection), 0)
+        loss += tf.reduce_sum(tf.square(difference))
 
+    return percent_lambda * loss / len(bandwidths)
+
+
+# Feature dimension from which CORAL uses gram_loss for unknown batch sizes, the
+# batches of the repo stay far below it, e.g. 16 + 16 images for 2048-d Xception
+GRAM_MIN_DIM = 512
+
+
+def covariance_loss(xm, xmt):
+    """[||Cs - Ct||² of the centred source & target features from the d x d
+    covariance matrices.]"""
     # Source covariance
-    xm = source_output - tf.reduce_mean(source_output, 0, keepdims=True)
-    xc = tf.matmul(tf.transpose(xm), xm) / source_batch_size
+    xc = tf.matmul(tf.transpose(xm), xm) / tf.cast(tf.shape(xm)[0], tf.float32)
 
     # Target covariance
-    xmt = target_output - tf.reduce_mean(target_output, 0, keepdims=True)
-    xct = tf.matmul(tf.transpose(xmt), xmt) / target_batch_size
+    xct = tf.matmul(tf.transpose(xmt), xmt) / tf.cast(tf.shape(xmt)[0], tf.float32)
 
     # Frobenius norm
     # loss = tf.sqrt(tf.reduce_sum(tf.multiply((xc - xct), (xc - xct))))
-    loss = tf.reduce_sum(tf.multiply((xc - xct), (xc - xct)))
+    return tf.reduce_sum(tf.multiply((xc - xct), (xc - xct)))
+
+
+def gram_loss(xm, xmt):
+    """[||Cs - Ct||² of the centred source & target features from the n x n Gram &
+    cross-Gram matrices, ||Xs Xs'||²/ns² + ||Xt Xt'||²/nt² -
+    2 ||Xs Xt'||²/(ns nt).]"""
+    source_batch_size = tf.cast(tf.shape(xm)[0], tf.float32)
+    target_batch_size = tf.cast(tf.shape(xmt)[0], tf.float32)
+    source_gram = tf.matmul(xm, xm, transpose_b=True) / source_batch_size
+    target_gram = tf.matmul(xmt, xmt, transpose_b=True) / target_batch_size
+    cross_gram = tf.matmul(xm, xmt, transpose_b=True)
+    return (
+        tf.reduce_sum(tf.square(source_gram))
+        + tf.reduce_sum(tf.square(target_gram))
+        - 2
+        * tf.reduce_sum(tf.square(cross_gram))
+        / (source_batch_size * target_batch_size)
+    )
+
+
+def CORAL(source_output, target_output, percent_lambda=0.5):
+    """[Deep CORAL loss function. When the batches are much smaller than the feature
+    dimension, ||Cs - Ct||² is computed exactly by gram_loss from the n x n Gram
+    matrices, instead of the two d x d covariance matrices of covariance_loss. The
+    form is chosen from the static shapes, the batch size is unknown when the loss
+    is built into a keras model, then features of at least GRAM_MIN_DIM dimensions
+    use gram_loss.]
+
+    Args:
+        source_output ([tf tensor]): [Source feature map tensor]
+        target_output ([tf tensor]): [Target feature map tensor]
+        percent_lambda (weighting factor, optional): [CORAL loss weighting factor]. Defaults to 0.5.
+
+    Returns:
+        [tf tensor]: [CORAL loss per batch]
+    """
+    source_batch_size = source_output.shape[0]
+    target_batch_size = target_output.shape[0]
+    d = source_output.shape[-1]
+
+    xm = source_output - tf.reduce_mean(source_output, 0, keepdims=True)
+    xmt = target_output - tf.reduce_mean(target_output, 0, keepdims=True)
+
+    if source_batch_size is None or target_batch_size is None:
+        use_gram = d >= GRAM_MIN_DIM
+    else:
+        use_gram = source_batch_size + target_batch_size < d
+
+    loss = gram_loss(xm, xmt) if use_gram else covariance_loss(xm, xmt)
     loss = loss / (4 * d * d)
     loss = percent_lambda * loss
     return loss
 
 
-def log_coral_loss(source_output, target_output, percent_lambda=0.5):
-    """[Calculate LogCoral loss]
+class RunningCORAL(tf.keras.layers.Layer):
+    """[Deep CORAL loss layer which keeps exponential moving averages of the source &
+    target means and second moments across the training steps. The loss value uses
+    the running covariances, which are far better estimates than the rank deficient
+    covariances of small batches. The gradient is the one of the current batch
+    covariances, so it doesn't shrink with the momentum.]
+
+    Args:
+        momentum (float, optional): [moving average momentum]. Defaults to 0.99.
+    """
+
+    def __init__(self, momentum=0.99, **kwargs):
+        super().__init__(**kwargs)
+        self.momentum = momentum
+
+    def add_moving_weight(self, name, shape):
+        # Per replica statistics averaged on read, as the BatchNormalization moving
+        # statistics, they can be assigned in the replica context of MirroredStrategy
+        return self.add_weight(
+            name=name,
+            shape=shape,
+            initializer="zeros",
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.MEAN,
+        )
+
+    def build(self, input_shape):
+        d = int(input_shape[0][-1])
+        self.steps = self.add_moving_weight("steps", ())
+        for domain in ("source", "target"):
+            setattr(
+                self, f"{domain}_mean", self.add_moving_weight(f"{domain}_mean", (d,))
+            )
+            setattr(
+                self,
+                f"{domain}_moment",
+                self.add_moving_weight(f"{domain}_moment", (d, d)),
+            )
+
+    def running_covariance(self, features, mean_var, moment_var, steps, training):
+        batch_size = tf.cast(tf.shape(features)[0], tf.float32)
+        batch_mean = tf.reduce_mean(features, 0)
+        xm = features - batch_mean
+        batch_cov = tf.matmul(xm, xm, transpose_a=True) / batch_size
+
+        # Moving averages including the current batch, bias corrected for the zero
+        # initialization
+        features = tf.stop_gradient(features)
+        mean = self.momentum * mean_var + (1 - self.momentum) * tf.stop_gradient(
+            batch_mean
+        )
+        moment = self.momentum * moment_var + (1 - self.momentum) * tf.matmul(
+            features, features, transpose_a=True
+        ) / batch_size
+        correction = 1 - self.momentum ** steps
+        running_mean = mean / correction
+        running_cov = moment / correction - tf.tensordot(
+            running_mean, running_mean, axes=0
+        )
+
+        if training:
+            mean_var.assign(mean)
+            moment_var.assign(moment)
+
+        # Value of the running covariance, gradient of the batch covariance
+        return running_cov + batch_cov - tf.stop_gradient(batch_cov)
+
+    def call(self, inputs, training=None):
+        source_output, target_output = inputs
+        d = tf.cast(tf.shape(source_output)[1], tf.float32)
+
+        steps = self.steps + 1
+        xc = self.running_covariance(
+            source_output, self.source_mean, self.source_moment, steps, training
+        )
+        xct = self.running_covariance(
+            target_output, self.target_mean, self.target_moment, steps, training
+        )
+        if training:
+            self.steps.assign(steps)
+
+        loss = tf.reduce_sum(tf.multiply((xc - xct), (xc - xct)))
+        return loss / (4 * d * d)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"momentum": self.momentum})
+        return config
+
+
+def running_coral(source_output, target_output, percent_lambda=0.5, momentum=0.99):
+    """[Deep CORAL loss on moving average covariances, see RunningCORAL. As the
+    loss is stateful, it has to be called once, when the model is built.]
+
+    Args:
+        source_output ([tf tensor]): [Source feature map tensor]
+        target_output ([tf tensor]): [Target feature map tensor]
+        percent_lambda (weighting factor, optional): [CORAL loss weighting factor]. Defaults to 0.5.
+        momentum (float, optional): [moving average momentum]. Defaults to 0.99.
+
+    Returns:
+        [tf tensor]: [CORAL loss per batch]
+    """
+    loss = RunningCORAL(momentum=momentum, dtype="float32", name="running_coral")(
+        [source_output, target_output]
+    )
+    return percent_lambda * loss
+
+
+def log_coral_loss(source_output, target_output, percent_lambda=0.5, gamma=1e-3):
+    """[Calculate LogCoral loss on the regularized covariances C + gamma * I.
+
+    The covariance of n samples has at most n - 1 non-zero eigenvalues, which are
+    the eigenvalues of the n x n Gram matrix H H' / (n - 1). With H' V the
+    matching eigenvectors, log(C + gamma * I) = log(gamma) * I + H' W H, where
+    W = V diag(log(1 + l / gamma) / ((n - 1) l)) V'. The log(gamma) * I terms
+    cancel out, so ||log(Cs) - log(Ct)||² only needs the n x n eigendecompositions
+    & Gram matrices, instead of two d x d eigendecompositions.]
 
        Args:
         source_output ([tf tensor]): [Source feature map tensor]
         target_output ([tf tensor]): [Target feature map tensor]
         percent_lambda (weighting factor, optional): [Log CORAL loss weighting factor]. Defaults to 0.5.
+        gamma (float, optional): [covariance regularization]. Defaults to 1e-3.
 
     Returns:
         [tf tensor]: [Log CORAL loss per batch]
     """
-    # regularized covariances result in inf or nan
-    # First: subtract the mean from the data matrix
-    h_src = source_output
-    h_trg = target_output
-    batch_size = tf.cast(tf.shape(h_src)[0], tf.float32)
-    h_src = h_src - tf.reduce_mean(h_src, axis=0)
-    h_trg = h_trg - tf.reduce_mean(h_trg, axis=0)
-    cov_source = (1.0 / (batch_size - 1)) * tf.matmul(
-        h_src, h_src, transpose_a=True
-    )  # + gamma * tf.eye(self.hidden_repr_size)
-    cov_target = (1.0 / (batch_size - 1)) * tf.matmul(h_trg, h_trg, transpose_a=True)
-    eig_source = tf.self_adjoint_eig(cov_source)
-    eig_target = tf.self_adjoint_eig(cov_target)
-    log_cov_source = tf.matmul(
-        eig_source[1],
-        tf.matmul(tf.diag(tf.log(eig_source[0])), eig_source[1], transpose_b=True),
-    )
-    log_cov_target = tf.matmul(
-        eig_target[1],
-        tf.matmul(tf.diag(tf.log(eig_target[0])), eig_target[1], transpose_b=True),
-    )
-    return percent_lambda * tf.reduce_mean(
-        tf.square(tf.subtract(log_cov_source, log_cov_target))
+    d = tf.cast(tf.shape(source_output)[1], tf.float32)
+
+    def log_weights(h):
+        # First: subtract the mean from the data matrix
+        h = h - tf.reduce_mean(h, axis=0)
+        n = tf.cast(tf.shape(h)[0], tf.float32)
+        gram = tf.matmul(h, h, transpose_b=True)
+        eigenvalues, eigenvectors = tf.linalg.eigh(gram / (n - 1))
+
+        # Null space directions don't contribute, any finite weight does for them
+        non_zero = eigenvalues > 1e-6 * gamma
+        safe_eigenvalues = tf.where(non_zero, eigenvalues, tf.ones_like(eigenvalues))
+        weights = tf.where(
+            non_zero,
+            tf.math.log1p(safe_eigenvalues / gamma) / ((n - 1) * safe_eigenvalues),
+            tf.ones_like(eigenvalues) / (gamma * (n - 1)),
+        )
+        w = tf.matmul(eigenvectors * weights, eigenvectors, transpose_b=True)
+        return h, gram, w
+
+    h_src, gram_source, w_source = log_weights(source_output)
+    h_trg, gram_target, w_target = log_weights(target_output)
+    cross_gram = tf.matmul(h_src, h_trg, transpose_b=True)
+
+    # tr(A B) = sum(A * B') for the traces of the expanded Frobenius norm
+    p_source = tf.matmul(w_source, gram_source)
+    p_target = tf.matmul(w_target, gram_target)
+    p_cross = tf.matmul(tf.matmul(w_source, cross_gram), w_target)
+    loss = (
+        tf.reduce_sum(p_source * tf.transpose(p_source))
+        + tf.reduce_sum(p_target * tf.transpose(p_target))
+        - 2 * tf.reduce_sum(p_cross * cross_gram)
     )
+
+    return percent_lambda * loss / (d * d)
@@ -1,7 +1,7 @@
 import tensorflow as tf
 from tensorflow.keras import models, layers
 import modules.config as cn
-from modules.loss import CORAL, coral_loss, kl_divergence
+from modules.loss import CORAL, kl_divergence
 import tensorflow_model_optimization as tfmot
 import numpy as np
 import os
@@ -15,6 +15,12 @@ def get_model(
     num_classes=31,
     lambda_loss=0.75,
     prune_val=0.10,
+    align_layers=(),
+    sketch_dim=64,
+    shared_backbone=False,
+    adapter_dim=0,
+    qat=False,
+    init_weights=None,
 ):
     """[This method generates the model objects for both the techniques - MBM & CDAN]
 
@@ -26,6 +32,12 @@ def get_model(
         num_classes (int, optional): [number of target domain classes]. Defaults to 31.
         lambda_loss (float, optional): [weightage factor for additional loss]. Defaults to 0.75.
         prune_val (float, optional): [pruning target sparsity value]. Defaults to 0.10.
+        align_layers (tuple, optional): [Xception layers also aligned by the domain loss]. Defaults to ().
+        sketch_dim (int, optional): [random projection size of the aligned layers, 0 keeps all channels]. Defaults to 64.
+        shared_backbone (bool, optional): [CDAN with shared convolutions & domain-specific BatchNorm]. Defaults to False.
+        adapter_dim (int, optional): [bottleneck size of the target adapter, 0 for none]. Defaults to 0.
+        qat (bool, optional): [quantization aware training of the optimized feature extractor]. Defaults to False.
+        init_weights (tuple, optional): [source & target backbone weights, loaded before pruning or quantization]. Defaults to None.
 
     Returns:
         [keras model]: [tf keras model object]
@@ -44,6 +56,9 @@ def get_model(
             pooling="avg",
             input_shape=input_shape,
         )
+        model = tap_backbone(model, align_layers)
+        if init_weights:
+            model.set_weights(init_weights[0])
         if prune:
             # Prune Target Model
             pruning_params = {
@@ -52,9 +67,16 @@ def get_model(
                 )
             }
             model = tfmot.sparsity.keras.prune_low_magnitude(model, **pruning_params)
+        if qat:
+            # Quantize Shared Model
+            model = tfmot.quantization.keras.quantize_model(model)
 
         source_op = model(inputs[0])
         target_op = model(inputs[1])
+        source_taps, target_taps = [], []
+        if align_layers:
+            source_op, *source_taps = source_op
+            target_op, *target_taps = target_op
 
     else:
         # CDAN technique
@@ -64,12 +86,22 @@ def get_model(
             pooling="avg",
             input_shape=input_shape,
         )
-        target_model = tf.keras.applications.Xception(
-            include_top=False,
-            weights="imagenet",
-            pooling="avg",
-            input_shape=input_shape,
-        )
+        source_model = tap_backbone(source_model, align_layers)
+
+        if shared_backbone:
+            target_model = domain_specific_copy(source_model)
+        else:
+            target_model = tf.keras.applications.Xception(
+                include_top=False,
+                weights="imagenet",
+                pooling="avg",
+                input_shape=input_shape,
+            )
+            target_model = tap_backbone(target_model, align_layers)
+
+        if init_weights:
+            source_model.set_weights(init_weights[0])
+            target_model.set_weights(init_weights[1])
 
         if prune:
             # Prune Target Model
@@ -82,22 +114,48 @@ def get_model(
                 target_model, **pruning_params
             )
 
-        # Renaming Layers
-        for layer in source_model.layers:
-            layer._name = layer.name + str("_1")
+        if qat:
+            # Quantize Target Model
+            target_model = tfmot.quantization.keras.quantize_model(target_model)
+
+        # Renaming Layers, the shared layers keep their name
+        if not shared_backbone:
+            # Both Xception models are named xception
+            source_model._name = source_model.name + str("_1")
+            target_model._name = target_model.name + str("_2")
 
-        for layer in target_model.layers:
-            layer._name = layer.name + str("_2")
+            for layer in source_model.layers:
+                layer._name = layer.name + str("_1")
+
+            for layer in target_model.layers:
+                layer._name = layer.name + str("_2")
 
         source_op = source_model(inputs[0])
         target_op = target_model(inputs[1])
+        source_taps, target_taps = [], []
+        if align_layers:
+            source_op, *source_taps = source_op
+            target_op, *target_taps = target_op
+
+        if adapter_dim:
+            target_op = adapter(target_op, adapter_dim, name="target_adapter")
+
+    # Under mixed precision the backbone features are cast back to float32, so that
+    # the domain alignment loss & the logits are computed in float32
+    source_op = layers.Activation("linear", dtype="float32", name="source_features")(
+        source_op
+    )
+    target_op = layers.Activation("linear", dtype="float32", name="target_features")(
+        target_op
+    )
 
     # Top Layer
-    classifier = layers.Dropout(0.3)(source_op)
+    classifier = layers.Dropout(0.3, dtype="float32")(source_op)
     classifier = tf.keras.layers.Dense(
         num_classes,
         kernel_initializer=cn.initializer,
         name="prediction",
+        dtype="float32",
     )(classifier)
     model = models.Model(inputs, classifier)
 
@@ -113,6 +171,186 @@ def get_model(
     model.add_loss(additive_loss)
     model.add_metric(additive_loss, name="CORAL_loss")
 
+    # Domain loss on the sketched intermediate features
+    for i, (name, source_tap, target_tap) in enumerate(
+        zip(align_layers, source_taps, target_taps)
+    ):
+        source_tap, target_tap = sketch_features(
+            source_tap, target_tap, name, sketch_dim, seed=i
+        )
+        tap_loss = additional_loss(
+            source_output=source_tap,
+            target_output=target_tap,
+            percent_lambda=lambda_loss,
+        )
+        model.add_loss(tap_loss)
+        model.add_metric(tap_loss, name=name + "_loss")
+
+    return model
+
+
+def get_backbones(model):
+    """[This method returns the source & target backbones of a get_model model, the
+    same one twice for MBM. The target backbone is the one optimized by pruning &
+    quantization.]"""
+    backbones = [layer for layer in model.layers if isinstance(layer, models.Model)]
+    if len(backbones) == 1:
+        return backbones[0], backbones[0]
+
+    target_backbone = [layer for layer in backbones if layer.name.endswith("_2")][0]
+    source_backbone = [layer for layer in backbones if layer is not target_backbone][0]
+    return source_backbone, target_backbone
+
+
+def tap_backbone(backbone, align_layers):
+    """[This method returns the backbone with the outputs of the align_layers
+    appended to its pooled output, the backbone itself if there are none.]"""
+    if not align_layers:
+        return backbone
+
+    return models.Model(
+        backbone.inputs,
+        [backbone.output] + [backbone.get_layer(name).output for name in align_layers],
+        name=backbone.name,
+    )
+
+
+def domain_specific_copy(backbone):
+    """[This method returns a copy of the backbone which shares all its layers but
+    the BatchNormalization ones. These are new layers, initialized with the
+    weights of the original ones, so every domain keeps its own normalization
+    statistics & affine parameters over the same convolution weights.]"""
+
+    def clone_function(layer):
+        if isinstance(layer, layers.BatchNormalization):
+            config = layer.get_config()
+            config["name"] = layer.name + "_2"
+            return layer.__class__.from_config(config)
+        return layer
+
+    target_model = tf.keras.models.clone_model(backbone, clone_function=clone_function)
+    target_model._name = backbone.name + "_2"
+    for layer in target_model.layers:
+        if isinstance(layer, layers.BatchNormalization):
+            layer.set_weights(backbone.get_layer(layer.name[:-2]).get_weights())
+
+    return target_model
+
+
+def adapter(features, adapter_dim, name):
+    """[Residual bottleneck adapter on the pooled features, features + W2 relu(W1
+    features). W2 starts at zero, so the adapter starts as the identity.]"""
+    residual = layers.Dense(adapter_dim, activation="relu", name=name + "_down")(
+        features
+    )
+    residual = layers.Dense(
+        features.shape[-1], kernel_initializer="zeros", name=name + "_up"
+    )(residual)
+    return layers.Add(name=name)([features, residual])
+
+
+def sketch_features(source_tap, target_tap, name, sketch_dim, seed=0):
+    """[This method reduces the source & target feature maps of an aligned layer to
+    pooled channel vectors, projected on sketch_dim fixed random directions shared
+    by both domains. The domain loss then works on sketch_dim x sketch_dim
+    covariances, instead of channels x channels ones.]
+
+    Args:
+        source_tap ([tf tensor]): [Source feature map of the aligned layer]
+        target_tap ([tf tensor]): [Target feature map of the aligned layer]
+        name ([str]): [name of the aligned layer]
+        sketch_dim ([int]): [projection size, 0 keeps all channels]
+        seed (int, optional): [seed of the random projection]. Defaults to 0.
+
+    Returns:
+        [tuple]: [source & target sketched features]
+    """
+    pooling = layers.GlobalAveragePooling2D(dtype="float32", name=name + "_pool")
+    source_tap, target_tap = pooling(source_tap), pooling(target_tap)
+
+    if sketch_dim and sketch_dim < source_tap.shape[-1]:
+        # Gaussian projection, scaled to keep the squared norms in expectation
+        sketch = layers.Dense(
+            sketch_dim,
+            use_bias=False,
+            trainable=False,
+            kernel_initializer=tf.keras.initializers.RandomNormal(
+                stddev=1 / np.sqrt(sketch_dim), seed=seed
+            ),
+            dtype="float32",
+            name=name + "_sketch",
+        )
+        source_tap, target_tap = sketch(source_tap), sketch(target_tap)
+
+    return source_tap, target_tap
+
+
+def get_feature_model(model):
+    """[This method returns a model sharing the layers of a get_model model, whose
+    outputs are the logits & the source and target features, the domain loss of
+    add_loss is left out.]"""
+    return models.Model(
+        model.inputs,
+        [
+            model.get_layer("prediction").output,
+            model.get_layer("source_features").output,
+            model.get_layer("target_features").output,
+        ],
+    )
+
+
+def get_head_model(
+    feature_dim,
+    additional_loss,
+    num_classes=31,
+    lambda_loss=0.75,
+):
+    """[This method generates the top layers of get_model on their own, trained on
+    top of pre-computed backbone features. The frozen features hold no trainable
+    variable, so the domain loss aligns the source & target logits of the shared
+    prediction layer, as the original Deep CORAL does.]
+
+    Args:
+        feature_dim ([int]): [dimension of the pooled backbone features]
+        additional_loss ([domain alignment loss function]): [Deep CORAL or other]
+        num_classes (int, optional): [number of target domain classes]. Defaults to 31.
+        lambda_loss (float, optional): [weightage factor for additional loss]. Defaults to 0.75.
+
+    Returns:
+        [keras model]: [tf keras model object]
+    """
+
+    inputs = [
+        tf.keras.layers.Input(shape=(feature_dim,)),
+        tf.keras.layers.Input(shape=(feature_dim,)),
+    ]
+
+    # Top Layer, shared by both domains
+    prediction = tf.keras.layers.Dense(
+        num_classes,
+        kernel_initializer=cn.initializer,
+        name="prediction",
+    )
+    classifier = prediction(layers.Dropout(0.3)(inputs[0]))
+    model = models.Model(inputs, classifier)
+
+    # The dropout would inflate the source covariance, the domain loss aligns the
+    # logits of both domains without it
+    source_classifier = prediction(inputs[0])
+    target_classifier = prediction(inputs[1])
+
+    # CORAL LOSS addition to the network
+    additional_loss = cn.LOSS[additional_loss]
+
+    additive_loss = additional_loss(
+        source_output=source_classifier,
+        target_output=target_classifier,
+        percent_lambda=lambda_loss,
+    )
+
+    model.add_loss(additive_loss)
+    model.add_metric(additive_loss, name="CORAL_loss")
+
     return model
 
 
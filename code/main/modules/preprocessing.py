@@ -1,39 +1,79 @@
 import os
+import json
 import tensorflow as tf
 import modules.config as cn
 import math
+import random
 import pandas as pd
 import tensorflow_datasets as tfds
 from pathlib import Path
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
+# Same extensions as accepted by image_dataset_from_directory
+IMAGE_FORMATS = (".bmp", ".gif", ".jpeg", ".jpg", ".png")
+
+# Same RGB <-> YIQ kernels as tf.image.rgb_to_yiq & tf.image.yiq_to_rgb
+RGB_TO_YIQ = [
+    [0.299, 0.59590059, 0.21153661],
+    [0.587, -0.27455667, -0.52273617],
+    [0.114, -0.32134392, 0.31119955],
+]
+YIQ_TO_RGB = [
+    [1.0, 1.0, 1.0],
+    [0.95598634, -0.27201283, -1.10674021],
+    [0.6208248, -0.64720424, 1.70423049],
+]
+
 
 def augment_ds(image, label, prob=0.2):
-    """[This method applied data augmentations to the source dataset.]"""
+    """[This method applies data augmentations to a batch of the source dataset.
+    Every random choice is made per sample with masks, and the Gaussian noise is
+    only drawn for the samples which get it.]"""
+
+    batch_size = tf.shape(image)[0]
+
+    def per_sample(minval, maxval):
+        return tf.random.uniform([batch_size, 1, 1, 1], minval=minval, maxval=maxval)
 
     # Make Images Greyscale
-    image = tf.cond(
-        tf.random.uniform(shape=[], minval=0, maxval=1) < prob,
-        lambda: tf.tile(tf.image.rgb_to_grayscale(image), [1, 1, 1, 3]),
-        lambda: image,
+    greyscale = per_sample(0, 1) < prob
+    image = tf.where(
+        greyscale, tf.tile(tf.image.rgb_to_grayscale(image), [1, 1, 1, 3]), image
     )
 
     # Adding Gaussian Noise
+    noisy = tf.where(tf.random.uniform(shape=[batch_size], minval=0, maxval=1) < prob)
     noise = tf.random.normal(
-        shape=tf.shape(image), mean=0.0, stddev=1, dtype=tf.float32
+        shape=tf.concat([tf.shape(noisy)[:1], tf.shape(image)[1:]], axis=0),
+        mean=0.0,
+        stddev=1,
+        dtype=tf.float32,
+    )
+    image = tf.tensor_scatter_nd_add(image, noisy, noise)
+
+    # Colour Augmentations, hue rotates & saturation scales the IQ plane of YIQ,
+    # both merged into one 3x3 colour matrix per sample
+    theta = 2 * math.pi * tf.random.uniform([batch_size], minval=-0.05, maxval=0.05)
+    saturation = tf.random.uniform([batch_size], minval=0.8, maxval=2.5)
+    cos, sin = saturation * tf.cos(theta), saturation * tf.sin(theta)
+    ones, zeros = tf.ones_like(cos), tf.zeros_like(cos)
+    iq_transform = tf.reshape(
+        tf.stack([ones, zeros, zeros, zeros, cos, sin, zeros, -sin, cos], axis=1),
+        [batch_size, 3, 3],
     )
-    image = tf.cond(
-        tf.random.uniform(shape=[], minval=0, maxval=1) < prob,
-        lambda: tf.add(image, noise),
-        lambda: image,
+    colour_matrix = tf.matmul(
+        tf.matmul(
+            tf.tile(tf.constant(RGB_TO_YIQ)[tf.newaxis], [batch_size, 1, 1]),
+            iq_transform,
+        ),
+        tf.constant(YIQ_TO_RGB),
     )
+    image = tf.einsum("bhwc,bcd->bhwd", image, colour_matrix)
 
-    # Colour Augmentations
-    image = tf.image.random_hue(image, 0.05)
-    image = tf.image.random_saturation(image, 0.8, 2.5)
-    image = tf.image.random_brightness(image, max_delta=0.4)
-    image = tf.image.random_contrast(image, lower=0.3, upper=1.2)
+    image = image + per_sample(-0.4, 0.4)  # Brightness
+    mean = tf.reduce_mean(image, axis=[1, 2], keepdims=True)
+    image = (image - mean) * per_sample(0.3, 1.2) + mean  # Contrast
 
     # Flipping Images
     # image = tf.image.random_flip_left_right(image)
@@ -41,28 +81,71 @@ def augment_ds(image, label, prob=0.2):
     return image, label
 
 
-def read_from_file(image_file, label):
-    directory = "/root/Master-Thesis/code/data/synthetic_data/train/"
-    image = tf.io.read_file(directory + image_file)
-    image = tf.image.decode_jpeg(image, channels=3)
-    image = tf.cast(image, tf.float32)
-    image = tf.image.resize(image, [71, 71], method="nearest")
-    image = tf.keras.applications.xception.preprocess_input(image)
-    label = tf.cast(label, tf.float32)
+def decode_at_size(contents, new_size):
+    """[Decodes a JPEG with the largest DCT downscaling (1/8, 1/4 or 1/2) which still
+    leaves both sides at least new_size pixels, small targets skip most of the full
+    resolution decode work.]"""
+    shape = tf.image.extract_jpeg_shape(contents)
+    min_side = tf.reduce_min(shape[:2])
 
-    return image, label
+    def decode(ratio):
+        return lambda: tf.io.decode_jpeg(contents, channels=3, ratio=ratio)
+
+    return tf.case(
+        [(min_side >= ratio * new_size, decode(ratio)) for ratio in (8, 4, 2)],
+        default=decode(1),
+    )
+
+
+def read_from_file(image_file, new_size):
+    """[Reads a SynSigns image, resized with nearest neighbour and kept as uint8.]"""
+    image = tf.io.read_file(image_file)
+    image = decode_at_size(image, new_size)
+    image = tf.image.resize(image, [new_size, new_size], method="nearest")
+
+    return image
+
+
+def read_synsigns(manifest, params, batch_size, seed=None, infinite=False):
+    """[This method reads the SynSigns images listed in the manifest, see read_domain
+    for the arguments. With cache_in_memory the decoded uint8 images are kept in RAM
+    after the first pass, about 1.5 GB for the 100k images at 71x71.]
+    """
+    ds = tf.data.Dataset.from_tensor_slices((manifest["files"], manifest["labels"]))
+
+    def load(file_path, label):
+        return read_from_file(file_path, params["resize"]), label
+
+    if params["cache_in_memory"]:
+        if infinite:
+            # Shuffled once before caching, afterwards only within a small buffer
+            ds = ds.shuffle(
+                manifest["num_images"], seed=seed, reshuffle_each_iteration=False
+            )
+        ds = ds.map(load, num_parallel_calls=cn.AUTOTUNE, deterministic=True).cache()
+        if infinite:
+            ds = ds.shuffle(batch_size * 8, seed=seed).repeat()
+    else:
+        if infinite:
+            ds = ds.shuffle(manifest["num_images"], seed=seed).repeat()
+        ds = ds.map(load, num_parallel_calls=cn.AUTOTUNE, deterministic=True)
+
+    ds = ds.batch(batch_size, drop_remainder=infinite)
 
+    return ds.map(preprocess, num_parallel_calls=cn.AUTOTUNE)
 
-def read_images(directory, batch_size, new_size):
-    ds = tf.keras.preprocessing.image_dataset_from_directory(
-        directory,
-        labels="inferred",
-        label_mode="int",  # categorical, binary
-        batch_size=batch_size,
-        image_size=(new_size, new_size),  # reshape if not in this size
-        shuffle=True,
+
+def read_images(manifest, batch_size, new_size, seed=None, infinite=False):
+    ds = tf.data.Dataset.from_tensor_slices((manifest["files"], manifest["labels"]))
+    ds = ds.shuffle(manifest["num_images"], seed=seed)
+    if infinite:
+        ds = ds.repeat()
+    ds = ds.map(
+        lambda file_path, label: (load_image(file_path, new_size), label),
+        num_parallel_calls=cn.AUTOTUNE,
+        deterministic=True,
     )
-    return ds
+    return ds.batch(batch_size, drop_remainder=infinite)
 
 
 def preprocess(image, label):
@@ -74,26 +157,21 @@ def preprocess(image, label):
     return image, label
 
 
-def prepare_office_ds(source_directory, target_directory, params):
-
-    source_ds_original = read_images(
-        source_directory, params["batch_size"], params["resize"]
-    )
-    target_ds_original = read_images(
-        target_directory, params["batch_size"], params["resize"]
-    )
-
-    source_ds_original = source_ds_original.map(
-        preprocess, num_parallel_calls=tf.data.experimental.AUTOTUNE
-    )
+def zip_domains(
+    source_ds_original, target_ds_original, params, source_manifest, target_manifest
+):
+    """[This method balances the source & target datasets, applies the augmentations
+    and zips them into the training and test datasets. All the batch counts come
+    from the domain manifests, so the datasets are never iterated here.]
+    """
 
-    target_ds_original = target_ds_original.map(
-        preprocess, num_parallel_calls=tf.data.experimental.AUTOTUNE
+    length_source_images = math.ceil(
+        source_manifest["num_images"] / params["batch_size"]
     )
-
-    length_source_images = source_ds_original.cardinality().numpy()
     tf.compat.v1.logging.info(f"length_source_images: {length_source_images}")
-    length_target_images = target_ds_original.cardinality().numpy()
+    length_target_images = math.ceil(
+        target_manifest["num_images"] / params["batch_size"]
+    )
     tf.compat.v1.logging.info(f"length_target_images: {length_target_images}")
 
     if length_source_images < length_target_images:
@@ -123,97 +201,498 @@ def prepare_office_ds(source_directory, target_directory, params):
         buffer_size=cn.AUTOTUNE
     )
 
-    train_count = [x for x in ds_train]
-    tf.compat.v1.logging.info("Batch count of training set: " + str(len(train_count)))
+    # The shorter domain is repeated, so the zip is as long as the longer one
+    train_count = max(length_source_images, length_target_images)
+    tf.compat.v1.logging.info("Batch count of training set: " + str(train_count))
 
-    test_count = [x for x in ds_test]
-    tf.compat.v1.logging.info("Batch count of test set: " + str(len(test_count)))
+    tf.compat.v1.logging.info("Batch count of test set: " + str(length_target_images))
 
     return ds_train, ds_test
 
 
-def fetch_data(params):
-    """[This method handles all the data preprocessing steps required to perform
-    domain adaptation on all scenarios.]
-    """
-
-    if cn.DATASET_COMBINATION[params["combination"]] == 1:
-        source_directory = cn.OFFICE_DS_PATH / "amazon"
-        target_directory = cn.OFFICE_DS_PATH / "webcam"
+def read_domain(domain, manifest, params, batch_size=None, seed=None, infinite=False):
+    """[This method reads, decodes & preprocesses the images of a domain.
 
-        return prepare_office_ds(source_directory, target_directory, params)
+    Args:
+        domain ([str]): [domain name, see config.DOMAINS]
+        manifest ([dict]): [domain manifest]
+        params ([dict]): [Argparse dictionary]
+        batch_size (int, optional): [batch size]. Defaults to params["batch_size"].
+        seed (int, optional): [shuffling seed]. Defaults to None.
+        infinite (bool, optional): [independently shuffled, infinitely repeating
+        stream of full batches]. Defaults to False.
 
-    elif cn.DATASET_COMBINATION[params["combination"]] == 2:
-        source_directory = cn.OFFICE_DS_PATH / "amazon"
-        target_directory = cn.OFFICE_DS_PATH / "dslr"
+    Returns:
+        [tf dataset]: [batched domain dataset]
+    """
+    batch_size = batch_size or params["batch_size"]
 
-        return prepare_office_ds(source_directory, target_directory, params)
+    if domain == "synsigns":
+        return read_synsigns(manifest, params, batch_size, seed, infinite)
 
-    elif cn.DATASET_COMBINATION[params["combination"]] == 3:
-        source_directory = cn.OFFICE_DS_PATH / "webcam"
-        target_directory = cn.OFFICE_DS_PATH / "amazon"
+    ds = read_images(manifest, batch_size, params["resize"], seed, infinite)
 
-        return prepare_office_ds(source_directory, target_directory, params)
+    return ds.map(preprocess, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
-    elif cn.DATASET_COMBINATION[params["combination"]] == 4:
-        source_directory = cn.OFFICE_DS_PATH / "dslr"
-        target_directory = cn.OFFICE_DS_PATH / "amazon"
 
-        return prepare_office_ds(source_directory, target_directory, params)
+def list_domain_files(domain):
+    """[This method lists the image files & integer labels of a domain. Office-31 and
+    GTSRB labels are inferred from the sorted class folders, the same way
+    image_dataset_from_directory does, SynSigns labels come from train_labelling.txt.]
 
-    elif cn.DATASET_COMBINATION[params["combination"]] == 5:
+    Args:
+        domain ([str]): [domain name, see config.DOMAINS]
 
-        synthetic_directory = cn.SYNTHETIC_PATH
+    Returns:
+        [tuple]: [list of file paths, list of labels]
+    """
+    directory = cn.DOMAINS[domain]
 
+    if domain == "synsigns":
         labels_data = pd.read_csv(
-            synthetic_directory / "train_labelling.txt", sep=" ", header=None
+            directory / "train_labelling.txt", sep=" ", header=None
         )
+        file_paths = [
+            str(directory / "train" / file_name) for file_name in labels_data[0].str[6:]
+        ]
+        return file_paths, labels_data[1].tolist()
 
-        file_paths = labels_data[0].str[6:]
-        labels = labels_data[1].values
+    class_names = sorted(
+        entry.name for entry in Path(directory).iterdir() if entry.is_dir()
+    )
+    file_paths, labels = [], []
+    for label, class_name in enumerate(class_names):
+        for root, _, files in sorted(os.walk(directory / class_name)):
+            for file_name in sorted(files):
+                if file_name.lower().endswith(IMAGE_FORMATS):
+                    file_paths.append(os.path.join(root, file_name))
+                    labels.append(label)
 
-        ds_source = tf.data.Dataset.from_tensor_slices((file_paths, labels))
+    return file_paths, labels
 
-        ds_source = ds_source.map(read_from_file, num_parallel_calls=cn.AUTOTUNE).batch(
-            params["batch_size"]
-        )
 
-        GTSRB_directory = cn.GTSRB_PATH
-        target_ds_original = read_images(
-            GTSRB_directory / Path("train"), params["batch_size"], params["resize"]
-        )
+def build_manifest(domain):
+    """[This method builds the manifest of a domain: its file list, labels, image
+    count and class histogram, and caches it on disk as json.]
 
-        target_ds_original = target_ds_original.map(
-            preprocess, num_parallel_calls=tf.data.experimental.AUTOTUNE
-        )
+    Args:
+        domain ([str]): [domain name, see config.DOMAINS]
 
-        length_source_images = ds_source.cardinality().numpy()
-        tf.compat.v1.logging.info(f"length_source_images: {length_source_images}")
-        length_target_images = target_ds_original.cardinality().numpy()
-        tf.compat.v1.logging.info(f"length_target_images: {length_target_images}")
+    Returns:
+        [dict]: [domain manifest]
+    """
+    file_paths, labels = list_domain_files(domain)
+
+    class_histogram = {}
+    for label in labels:
+        class_histogram[label] = class_histogram.get(label, 0) + 1
+
+    manifest = {
+        "domain": domain,
+        "num_images": len(file_paths),
+        "num_classes": len(class_histogram),
+        "class_histogram": {str(k): v for k, v in sorted(class_histogram.items())},
+        "files": file_paths,
+        "labels": labels,
+    }
+
+    Path(cn.MANIFEST_DIR).mkdir(parents=True, exist_ok=True)
+    with open(cn.MANIFEST_DIR / f"{domain}.json", "w") as f:
+        json.dump(manifest, f)
+
+    return manifest
+
+
+def load_manifest(domain):
+    """[This method loads the cached manifest of a domain, it is built on first use.
+    Delete the json file to rebuild it after the dataset changed.]
+    """
+    manifest_path = cn.MANIFEST_DIR / f"{domain}.json"
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    else:
+        tf.compat.v1.logging.info(f"Building the manifest of {domain} ...")
+        manifest = build_manifest(domain)
+
+    tf.compat.v1.logging.info(
+        f"Domain {domain}: {manifest['num_images']} images, "
+        f"{manifest['num_classes']} classes"
+    )
+
+    return manifest
+
+
+def load_image(file_path, new_size, method="bilinear"):
+    """[Reads, decodes & resizes a single image.]"""
+    image = tf.io.read_file(file_path)
+    image = tf.image.decode_image(image, channels=3, expand_animations=False)
+    image = tf.image.resize(image, [new_size, new_size], method=method)
+
+    return image
 
-        ds_target = target_ds_original.repeat(
-            math.ceil(length_source_images / length_target_images)
-        )
 
-        if params["augment"]:
-            ds_source = ds_source.map(augment_ds, num_parallel_calls=cn.AUTOTUNE)
+def serialize_example(image, label):
+    feature = {
+        "image": tf.train.Feature(
+            bytes_list=tf.train.BytesList(value=[image.tobytes()])
+        ),
+        "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+    }
+    example = tf.train.Example(features=tf.train.Features(feature=feature))
 
-        ds_train = tf.data.Dataset.zip((ds_source, ds_target)).map(
-            lambda x, y: ((x[0], y[0]), x[1]), num_parallel_calls=cn.AUTOTUNE
+    return example.SerializeToString()
+
+
+def parse_examples(serialized, new_size):
+    """[Parses a batch of serialized examples back into uint8 images & labels.]"""
+    features = tf.io.parse_example(
+        serialized,
+        {
+            "image": tf.io.FixedLenFeature([], tf.string),
+            "label": tf.io.FixedLenFeature([], tf.int64),
+        },
+    )
+    image = tf.io.decode_raw(features["image"], tf.uint8)
+    image = tf.reshape(image, [-1, new_size, new_size, 3])
+
+    return image, features["label"]
+
+
+def compile_domain(domain, new_size, num_shards=cn.NUM_SHARDS):
+    """[This method decodes & resizes every image of a domain once and writes them
+    as uint8 TFRecord shards, keyed by domain and resize value. Nothing is done if
+    the shards already exist.]
+
+    Args:
+        domain ([str]): [domain name, see config.DOMAINS]
+        new_size ([int]): [image resizing dimensions]
+        num_shards (int, optional): [number of shards]. Defaults to cn.NUM_SHARDS.
+
+    Returns:
+        [Path]: [directory of the compiled shards]
+    """
+    shard_dir = cn.CACHE_DIR / f"{domain}_{new_size}"
+    meta_path = shard_dir / "meta.json"
+    if meta_path.exists():
+        return shard_dir
+
+    tf.compat.v1.logging.info(f"Compiling {domain} dataset at {shard_dir} ...")
+    Path(shard_dir).mkdir(parents=True, exist_ok=True)
+
+    manifest = load_manifest(domain)
+    file_paths, labels = manifest["files"], manifest["labels"]
+
+    # Shuffled once, so that every shard holds a mix of all the classes
+    ds = tf.data.Dataset.from_tensor_slices((file_paths, labels)).shuffle(
+        len(file_paths), seed=1337, reshuffle_each_iteration=False
+    )
+
+    def load(file_path, label):
+        if domain == "synsigns":
+            return read_from_file(file_path, new_size), label
+
+        image = tf.round(load_image(file_path, new_size))
+        return tf.saturate_cast(image, tf.uint8), label
+
+    ds = ds.map(load, num_parallel_calls=cn.AUTOTUNE)
+
+    writers = [
+        tf.io.TFRecordWriter(
+            str(shard_dir / f"shard-{i:05d}-of-{num_shards:05d}.tfrecord")
+        )
+        for i in range(num_shards)
+    ]
+    num_examples = 0
+    for image, label in ds.as_numpy_iterator():
+        writers[num_examples % num_shards].write(serialize_example(image, label))
+        num_examples += 1
+    for writer in writers:
+        writer.close()
+
+    # meta.json is written last and marks the shards as complete
+    with open(meta_path, "w") as f:
+        json.dump(
+            {
+                "domain": domain,
+                "resize": new_size,
+                "num_examples": num_examples,
+                "num_shards": num_shards,
+            },
+            f,
         )
-        ds_train = ds_train.prefetch(buffer_size=cn.AUTOTUNE)
+    tf.compat.v1.logging.info(f"Compiled {num_examples} images of {domain}")
 
-        ds_test = target_ds_original.map(lambda x, y: ((x, x), y)).prefetch(
-            buffer_size=cn.AUTOTUNE
+    return shard_dir
+
+
+def keep_class_quota(ds, class_quota):
+    """[Keeps the first class_quota[label] serialized examples of every class.]"""
+    quota = tf.constant(class_quota, tf.int64)
+
+    def count(counts, serialized):
+        label = tf.io.parse_single_example(
+            serialized, {"label": tf.io.FixedLenFeature([], tf.int64)}
+        )["label"]
+        kept = counts[label] < quota[label]
+        counts += tf.one_hot(label, len(class_quota), dtype=tf.int64)
+        return counts, (serialized, kept)
+
+    ds = ds.apply(tf.data.experimental.scan(tf.zeros_like(quota), count))
+    return ds.filter(lambda serialized, kept: kept).map(
+        lambda serialized, kept: serialized
+    )
+
+
+def read_compiled_domain(
+    domain,
+    params,
+    shuffle=True,
+    batch_size=None,
+    seed=None,
+    infinite=False,
+    class_quota=None,
+):
+    """[This method streams the compiled shards of a domain with a parallel
+    interleave, only the float cast & xception preprocessing are done at run time.
+    See read_domain for the batch_size, seed & infinite arguments. With a
+    class_quota list, only the first class_quota[label] examples of every class are
+    kept, only their labels are parsed to skip the others.]
+    """
+    batch_size = batch_size or params["batch_size"]
+    shard_dir = compile_domain(domain, params["resize"])
+    with open(shard_dir / "meta.json") as f:
+        meta = json.load(f)
+
+    files = tf.data.Dataset.list_files(
+        str(shard_dir / "*.tfrecord"), shuffle=shuffle, seed=seed
+    )
+    ds = files.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=meta["num_shards"],
+        num_parallel_calls=cn.AUTOTUNE,
+        deterministic=True,
+    )
+    num_examples = meta["num_examples"]
+    if class_quota is not None:
+        ds = keep_class_quota(ds, class_quota)
+        num_examples = sum(class_quota)
+    if shuffle:
+        ds = ds.shuffle(buffer_size=batch_size * 8, seed=seed)
+    if infinite:
+        ds = ds.repeat()
+
+    ds = ds.batch(batch_size, drop_remainder=infinite)
+    ds = ds.map(
+        lambda x: parse_examples(x, params["resize"]), num_parallel_calls=cn.AUTOTUNE
+    )
+    ds = ds.map(preprocess, num_parallel_calls=cn.AUTOTUNE)
+
+    if infinite:
+        return ds
+
+    # The TFRecord stream has no known length, restore it from the metadata
+    return ds.apply(
+        tf.data.experimental.assert_cardinality(math.ceil(num_examples / batch_size))
+    )
+
+
+def compile_data(params):
+    """[This method compiles the source & target domains of the chosen scenario.]"""
+    for domain in cn.DOMAIN_PAIRS[cn.DATASET_COMBINATION[params["combination"]]]:
+        compile_domain(domain, params["resize"])
+
+
+def sample_domains(source_domain, target_domain, params):
+    """[This method draws the source & target batches from independently shuffled,
+    infinitely repeating streams. The epoch length is given by steps_per_epoch
+    instead of the larger domain, and source_ratio sets how many source images are
+    drawn per target image.]
+    """
+    target_batch_size = max(1, round(params["batch_size"] / params["source_ratio"]))
+    tf.compat.v1.logging.info(
+        f"Infinite sampler: {params['batch_size']} source & {target_batch_size} "
+        f"target images per step, {train_steps(params)} steps per epoch"
+    )
+
+    # Different seeds keep both streams independent, but reproducible
+    seed = params["seed"]
+    target_seed = None if seed is None else seed + 1
+
+    if params["use_cache"]:
+        source_ds = read_compiled_domain(
+            source_domain, params, seed=seed, infinite=True
+        )
+        target_ds = read_compiled_domain(
+            target_domain,
+            params,
+            batch_size=target_batch_size,
+            seed=target_seed,
+            infinite=True,
         )
+    else:
+        source_ds = read_domain(
+            source_domain,
+            load_manifest(source_domain),
+            params,
+            seed=seed,
+            infinite=True,
+        )
+        target_ds = read_domain(
+            target_domain,
+            load_manifest(target_domain),
+            params,
+            batch_size=target_batch_size,
+            seed=target_seed,
+            infinite=True,
+        )
+
+    if params["augment"]:
+        source_ds = source_ds.map(augment_ds, num_parallel_calls=cn.AUTOTUNE)
+
+    ds_train = tf.data.Dataset.zip((source_ds, target_ds)).map(
+        lambda x, y: ((x[0], y[0]), x[1]),
+        num_parallel_calls=cn.AUTOTUNE,
+        deterministic=True,
+    )
+
+    return ds_train.prefetch(buffer_size=cn.AUTOTUNE)
+
+
+def train_steps(params):
+    """[This method returns the steps per epoch of the infinite sampler, by default
+    as many batches as the larger domain has. None for the repeat sampler, whose
+    datasets are finite.]
+    """
+    if params["sampler"] != "infinite":
+        return None
 
-        train_count = [x for x in ds_train]
+    if params["steps_per_epoch"]:
+        return params["steps_per_epoch"]
+
+    return max(
+        math.ceil(load_manifest(domain)["num_images"] / params["batch_size"])
+        for domain in cn.DOMAIN_PAIRS[cn.DATASET_COMBINATION[params["combination"]]]
+    )
+
+
+def stratified_manifest(manifest, fraction, seed=None):
+    """[This method returns a manifest with the given fraction of the images of every
+    class, at least one per class, so the subset keeps the class balance.]
+
+    Args:
+        manifest ([dict]): [domain manifest]
+        fraction ([float]): [fraction of the images kept]
+        seed (int, optional): [sampling seed]. Defaults to None.
+
+    Returns:
+        [dict]: [manifest of the subset]
+    """
+    rng = random.Random(seed)
+    by_class = {}
+    for file_path, label in zip(manifest["files"], manifest["labels"]):
+        by_class.setdefault(label, []).append(file_path)
+
+    files, labels = [], []
+    for label, class_files in sorted(by_class.items()):
+        kept = rng.sample(class_files, max(1, round(fraction * len(class_files))))
+        files += kept
+        labels += [label] * len(kept)
+
+    return dict(
+        manifest,
+        files=files,
+        labels=labels,
+        num_images=len(files),
+        class_histogram={str(k): labels.count(k) for k in sorted(by_class)},
+    )
+
+
+def fetch_validation_data(params):
+    """[This method builds the single input (x, y) validation dataset of the target
+    domain, on a stratified subset of val_subset of its images. With use_cache the
+    subset is read from the compiled shards, whose order was shuffled once when
+    they were compiled, so the seed isn't used there.]
+    """
+    _, target_domain = cn.DOMAIN_PAIRS[cn.DATASET_COMBINATION[params["combination"]]]
+    manifest = load_manifest(target_domain)
+
+    if params["val_subset"] < 1:
+        subset = stratified_manifest(manifest, params["val_subset"], params["seed"])
         tf.compat.v1.logging.info(
-            "Batch count of training set: " + str(len(train_count))
+            f"Validating on {subset['num_images']} images of {target_domain}"
+        )
+
+    if params["use_cache"]:
+        class_quota = None
+        if params["val_subset"] < 1:
+            # Same number of images per class as the stratified subset
+            class_quota = [
+                subset["class_histogram"].get(str(label), 0)
+                for label in range(max(manifest["labels"]) + 1)
+            ]
+        ds_val = read_compiled_domain(
+            target_domain, params, shuffle=False, class_quota=class_quota
         )
+    elif params["val_subset"] < 1:
+        ds_val = read_domain(target_domain, subset, params)
+    else:
+        ds_val = read_domain(target_domain, manifest, params)
+
+    return ds_val.prefetch(buffer_size=cn.AUTOTUNE)
+
+
+def fetch_test_data(params):
+    """[This method builds only the ((x, x), y) test dataset of the target domain,
+    the same one as fetch_data returns, without the source domain & the training
+    pipeline. Nothing is iterated, the batch count comes from the manifest.]
+    """
+    _, target_domain = cn.DOMAIN_PAIRS[cn.DATASET_COMBINATION[params["combination"]]]
+    target_manifest = load_manifest(target_domain)
+
+    if params["use_cache"]:
+        target_ds_original = read_compiled_domain(target_domain, params, shuffle=False)
+    else:
+        target_ds_original = read_domain(target_domain, target_manifest, params)
+
+    tf.compat.v1.logging.info(
+        "Batch count of test set: "
+        + str(math.ceil(target_manifest["num_images"] / params["batch_size"]))
+    )
+
+    return target_ds_original.map(lambda x, y: ((x, x), y)).prefetch(
+        buffer_size=cn.AUTOTUNE
+    )
+
 
-        test_count = [x for x in ds_test]
-        tf.compat.v1.logging.info("Batch count of test set: " + str(len(test_count)))
+def fetch_data(params):
+    """[This method handles all the data preprocessing steps required to perform
+    domain adaptation on all scenarios.]
+    """
+
+    source_domain, target_domain = cn.DOMAIN_PAIRS[
+        cn.DATASET_COMBINATION[params["combination"]]
+    ]
+    source_manifest = load_manifest(source_domain)
+    target_manifest = load_manifest(target_domain)
 
-        return ds_train, ds_test
+    if params["sampler"] == "infinite":
+        ds_train = sample_domains(source_domain, target_domain, params)
+
+        return ds_train, fetch_test_data(params)
+
+    if params["use_cache"]:
+        tf.compat.v1.logging.info("Reading the compiled TFRecord shards ...")
+        source_ds_original = read_compiled_domain(source_domain, params)
+        target_ds_original = read_compiled_domain(target_domain, params)
+    else:
+        source_ds_original = read_domain(source_domain, source_manifest, params)
+        target_ds_original = read_domain(target_domain, target_manifest, params)
+
+    return zip_domains(
+        source_ds_original,
+        target_ds_original,
+        params,
+        source_manifest,
+        target_manifest,
+    )
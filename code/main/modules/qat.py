@@ -0,0 +1,145 @@
+import tensorflow as tf
+import os
+import json
+from pathlib import Path
+import tensorflow_model_optimization as tfmot
+import modules.config as cn
+import modules.utils as utils
+from modules.models import get_model, get_backbones
+from modules.preprocessing import train_steps
+from modules.serving import build_serving_model
+from modules.quantization import target_images, convert_tflite, evaluate_tflite
+
+
+class PreserveSparsity(tf.keras.callbacks.Callback):
+    """[This callback sets the pruned weights of the given kernels back to zero after
+    every training step, so the quantization aware fine-tuning keeps the sparsity
+    of the pruning.]
+
+    Args:
+        kernels ([list]): [kernel variables of the pruned layers]
+    """
+
+    def __init__(self, kernels):
+        super().__init__()
+        self.kernels = kernels
+        self.masks = [tf.cast(kernel != 0, kernel.dtype) for kernel in kernels]
+
+    def on_train_batch_end(self, batch, logs=None):
+        for kernel, mask in zip(self.kernels, self.masks):
+            kernel.assign(kernel * mask)
+
+
+def sparsity(kernels):
+    """[Fraction of zero weights of the given kernels.]"""
+    zeros = sum(int(tf.math.count_nonzero(kernel == 0)) for kernel in kernels)
+    return zeros / max(sum(kernel.shape.num_elements() for kernel in kernels), 1)
+
+
+def train_qat(model, params, ds_train, ds_test, log_dir):
+    """[This method fine-tunes a model trained with pruning for qat_epochs with
+    quantization aware training of its pruned feature extractor, the target one
+    for CDAN & the shared one for MBM. The pruning wrappers are stripped, the
+    model is rebuilt with the quantized extractor on the trained weights and the
+    pruned weights are kept at zero. The prediction branch of the extractor is
+    exported as an int8 TFLite model, next to the post-training quantized & the
+    float32 pruned ones for comparison.]
+
+    Args:
+        model ([keras model]): [model trained with pruning, from get_model]
+        params ([dict]): [Argparse dictionary]
+        ds_train ([tf dataset]): [training dataset]
+        ds_test ([tf dataset]): [test dataset]
+        log_dir ([str]): [log path of the run]
+
+    Returns:
+        [tuple]: [quantization aware model, report of the TFLite models]
+    """
+    stripped = tfmot.sparsity.keras.strip_pruning(model)
+    source_backbone, target_backbone = get_backbones(stripped)
+
+    tf.compat.v1.logging.info("Building the quantization aware model ...")
+    qat_model = get_model(
+        input_shape=params["input_shape"],
+        num_classes=params["output_classes"],
+        lambda_loss=params["lambda_loss"],
+        additional_loss=params["loss_function"],
+        prune=False,
+        technique=params["technique"],
+        align_layers=utils.align_layers(params),
+        sketch_dim=params["sketch_dim"],
+        qat=True,
+        init_weights=(source_backbone.get_weights(), target_backbone.get_weights()),
+    )
+    # Prediction head, adapter & sketches
+    for layer in qat_model.layers:
+        if not isinstance(layer, tf.keras.Model) and layer.weights:
+            layer.set_weights(stripped.get_layer(layer.name).get_weights())
+
+    qat_model.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=params["learning_rate"]),
+        loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+        metrics=["accuracy"],
+    )
+
+    _, qat_backbone = get_backbones(qat_model)
+    kernels = [
+        weight
+        for weight in qat_backbone.trainable_weights
+        if "kernel" in weight.name and sparsity([weight]) > 0
+    ]
+    tf.compat.v1.logging.info(
+        f"Quantization aware training of {qat_backbone.name}, sparsity of the pruned "
+        f"kernels: {sparsity(kernels):.3f}"
+    )
+    qat_model.fit(
+        ds_train,
+        validation_data=ds_test,
+        epochs=params["qat_epochs"],
+        steps_per_epoch=train_steps(params),
+        verbose=1,
+        callbacks=[PreserveSparsity(kernels)],
+    )
+    tf.compat.v1.logging.info(f"Sparsity after the training: {sparsity(kernels):.3f}")
+
+    # The pruned & quantized extractor with the prediction head
+    branch = "target" if params["technique"] else "source"
+    ds_images = target_images(ds_test)
+    output_dir = os.path.join(
+        cn.MODEL_PATH, (Path(log_dir).parent).name, Path(log_dir).name, "qat"
+    )
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    report = {}
+    ds_calibration = ds_images.shuffle(1000)
+    for name, serving_model, calibration in (
+        ("pruned_float32", build_serving_model(stripped, branch), None),
+        ("pruned_ptq_int8", build_serving_model(stripped, branch), ds_calibration),
+        ("pruned_qat_int8", build_serving_model(qat_model, branch), ds_calibration),
+    ):
+        tf.compat.v1.logging.info(f"Converting the {name} TFLite model ...")
+        tflite_model = convert_tflite(
+            serving_model, calibration, params["calibration_samples"]
+        )
+        tflite_path = os.path.join(output_dir, f"model_{name}.tflite")
+        with open(tflite_path, "wb") as f:
+            f.write(tflite_model)
+
+        report[name] = evaluate_tflite(tflite_model, ds_images)
+        report[name]["size_mb"] = os.path.getsize(tflite_path) / (1024 ** 2)
+        # The zeros of the pruned weights only shrink the compressed size
+        gzipped_size = utils.get_gzipped_file_size(tflite_path)
+        report[name]["gzipped_size_mb"] = gzipped_size / (1024 ** 2)
+        tf.compat.v1.logging.info(f"{name}: {report[name]}")
+
+    for name in ("pruned_ptq_int8", "pruned_qat_int8"):
+        tf.compat.v1.logging.info(
+            f"{name} accuracy vs pruned_float32: "
+            f"{report[name]['accuracy'] - report['pruned_float32']['accuracy']:+.4f}"
+        )
+
+    with open(os.path.join(output_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    tf.compat.v1.logging.info(f"TFLite models & report saved at: {output_dir}")
+
+    return qat_model, report
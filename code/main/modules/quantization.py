@@ -0,0 +1,143 @@
+import tensorflow as tf
+from tensorflow import keras
+import os
+import time
+import json
+import numpy as np
+from pathlib import Path
+import modules.config as cn
+import modules.utils as utils
+from modules.preprocessing import fetch_test_data
+from modules.serving import build_serving_model
+
+
+def target_images(ds_test):
+    """[Single target images of the ((x, x), y) test dataset of fetch_test_data.]"""
+    return ds_test.unbatch().map(lambda x, y: (x[0], y))
+
+
+def convert_tflite(serving_model, ds_calibration=None, num_samples=200):
+    """[This method converts a serving model into a TFLite model, in float32 or, with
+    calibration images, in full integer int8 with int8 inputs & outputs.
+
+    Args:
+        serving_model ([keras model]): [model from build_serving_model]
+        ds_calibration ([tf dataset], optional): [(x, y) images, calibrating the
+        activation ranges]. Defaults to None, float32.
+        num_samples (int, optional): [calibration images]. Defaults to 200.
+
+    Returns:
+        [bytes]: [TFLite flatbuffer]
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(serving_model)
+
+    if ds_calibration is not None:
+
+        def representative_dataset():
+            for image, _ in ds_calibration.take(num_samples):
+                yield [image[tf.newaxis]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+
+    return converter.convert()
+
+
+def evaluate_tflite(tflite_model, ds_images, num_threads=None):
+    """[This method runs a TFLite model image by image on the CPU, quantizing the
+    inputs of an int8 model with its input scale & zero point.
+
+    Args:
+        tflite_model ([bytes]): [TFLite flatbuffer]
+        ds_images ([tf dataset]): [(x, y) single images]
+        num_threads (int, optional): [interpreter threads]. Defaults to None.
+
+    Returns:
+        [dict]: [accuracy, mean, p50 & p99 latency in ms]
+    """
+    interpreter = tf.lite.Interpreter(
+        model_content=tflite_model, num_threads=num_threads
+    )
+    interpreter.allocate_tensors()
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    scale, zero_point = input_details["quantization"]
+
+    correct, latencies = 0, []
+    for image, label in ds_images.as_numpy_iterator():
+        if input_details["dtype"] == np.int8:
+            image = np.round(image / scale + zero_point)
+            image = np.clip(image, -128, 127).astype(np.int8)
+        interpreter.set_tensor(input_details["index"], image[np.newaxis])
+
+        start = time.perf_counter()
+        interpreter.invoke()
+        latencies.append(1000 * (time.perf_counter() - start))
+
+        # Dequantization keeps the order of the logits
+        logits = interpreter.get_tensor(output_details["index"])[0]
+        correct += int(np.argmax(logits) == int(label))
+
+    return {
+        "accuracy": correct / len(latencies),
+        "mean_ms": float(np.mean(latencies)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def quantize(model_path, params):
+    """[This method converts the serving model of a saved get_model model, or of its
+    stripped pruned_model, the target branch for CDAN, into an int8 TFLite model
+    calibrated on target images, and reports its size, CPU latency & accuracy
+    against the float32 one.]
+
+    Args:
+        model_path ([str]): [path of the trained keras model]
+        params ([dict]): [Argparse dictionary]
+
+    Returns:
+        [dict]: [report of the float32 & int8 models]
+    """
+    output_dir = os.path.join(Path(model_path).parent, "tflite")
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    utils.define_logger(os.path.join(output_dir, "quantization.log"))
+
+    tf.compat.v1.logging.info("Loading the trained model ...")
+    model = keras.models.load_model(model_path, custom_objects=cn.CUSTOM_OBJECTS)
+    # CDAN deploys only the target extractor, the one pruned by prune
+    serving_model = build_serving_model(
+        model, "target" if params["technique"] else "source"
+    )
+
+    ds_images = target_images(fetch_test_data(params))
+
+    report = {}
+    for name, ds_calibration in (("float32", None), ("int8", ds_images.shuffle(1000))):
+        tf.compat.v1.logging.info(f"Converting the {name} TFLite model ...")
+        tflite_model = convert_tflite(
+            serving_model, ds_calibration, params["calibration_samples"]
+        )
+        tflite_path = os.path.join(output_dir, f"model_{name}.tflite")
+        with open(tflite_path, "wb") as f:
+            f.write(tflite_model)
+
+        tf.compat.v1.logging.info(f"Evaluating the {name} TFLite model ...")
+        report[name] = evaluate_tflite(tflite_model, ds_images)
+        report[name]["size_mb"] = os.path.getsize(tflite_path) / (1024 ** 2)
+        tf.compat.v1.logging.info(f"{name}: {report[name]}")
+
+    float32, int8 = report["float32"], report["int8"]
+    tf.compat.v1.logging.info(
+        f"int8 vs float32: {float32['size_mb'] / int8['size_mb']:.1f}x smaller, "
+        f"{float32['p50_ms'] / int8['p50_ms']:.1f}x faster (p50), accuracy "
+        f"{int8['accuracy'] - float32['accuracy']:+.4f}"
+    )
+
+    with open(os.path.join(output_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    return report
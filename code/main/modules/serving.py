@@ -0,0 +1,115 @@
+import tensorflow as tf
+from tensorflow import keras
+import os
+import json
+from pathlib import Path
+import modules.config as cn
+import modules.utils as utils
+
+
+def build_serving_model(model, branch="source"):
+    """[This method cuts the source branch & the prediction head out of a get_model
+    model. The returned model takes a single batch of preprocessed images, the
+    target branch & the domain alignment loss are left out. Pruned runs are
+    exported from their stripped pruned_model.]
+
+    Args:
+        model ([keras model]): [trained model from get_model]
+        branch (str, optional): ['source', or 'target' for the target feature
+        extractor with the prediction head]. Defaults to "source".
+
+    Returns:
+        [keras model]: [single input model returning the logits]
+    """
+    if branch == "target":
+        # The prediction head is shared, Dropout is the identity at inference
+        features = model.get_layer("target_features").output
+        logits = model.get_layer("prediction")(features)
+        return keras.Model(model.inputs[1], logits, name="target_serving_model")
+
+    return keras.Model(
+        model.inputs[0], model.get_layer("prediction").output, name="serving_model"
+    )
+
+
+def export_serving_model(serving_model, export_dir, batch_size, input_shape):
+    """[This method saves the serving model as a SavedModel, whose serving_default
+    signature has a fixed batch dimension & returns the logits & probabilities.]
+
+    Args:
+        serving_model ([keras model]): [model from build_serving_model]
+        export_dir ([str]): [SavedModel directory]
+        batch_size ([int]): [batch dimension of the signature]
+        input_shape ([tuple]): [image shape, e.g. (299, 299, 3)]
+
+    Returns:
+        [tf function]: [the serving signature]
+    """
+
+    @tf.function(
+        input_signature=[
+            tf.TensorSpec([batch_size, *input_shape], tf.float32, name="images")
+        ]
+    )
+    def serve(images):
+        logits = serving_model(images, training=False)
+        return {"logits": logits, "probabilities": tf.nn.softmax(logits)}
+
+    Path(export_dir).mkdir(parents=True, exist_ok=True)
+    tf.saved_model.save(
+        serving_model, export_dir, signatures={"serving_default": serve}
+    )
+    tf.compat.v1.logging.info(f"Serving model saved at: {export_dir}")
+
+    return serve
+
+
+def export(model_path, params):
+    """[This method exports the single input serving model of a saved get_model
+    model next to it, and benchmarks its latency against the two input model.]
+
+    Args:
+        model_path ([str]): [path of the trained keras model]
+        params ([dict]): [Argparse dictionary]
+
+    Returns:
+        [dict]: [latency of both models]
+    """
+    export_dir = os.path.join(Path(model_path).parent, "serving_model")
+    utils.define_logger(os.path.join(Path(model_path).parent, "export.log"))
+
+    tf.compat.v1.logging.info("Loading the trained model ...")
+    model = keras.models.load_model(model_path, custom_objects=cn.CUSTOM_OBJECTS)
+
+    tf.compat.v1.logging.info("Exporting the serving model ...")
+    serving_model = build_serving_model(model)
+    export_serving_model(
+        serving_model, export_dir, params["batch_size"], params["input_shape"]
+    )
+    serve = tf.saved_model.load(export_dir).signatures["serving_default"]
+
+    # The ((x, x), y) test batches feed the same images to both branches
+    images = tf.random.uniform(
+        [params["batch_size"], *params["input_shape"]], -1.0, 1.0
+    )
+    full_model = tf.function(lambda x: model([x, x], training=False))
+
+    tf.compat.v1.logging.info("Measuring the latency of both models ...")
+    latency = {
+        "two_input_model": utils.measure_latency(full_model, images),
+        "serving_model": utils.measure_latency(lambda x: serve(images=x), images),
+    }
+    for name, metrics in latency.items():
+        tf.compat.v1.logging.info(
+            f"{name} (batch {params['batch_size']}): {metrics['mean_ms']:.1f} ms "
+            f"mean, {metrics['p50_ms']:.1f} ms p50, {metrics['p99_ms']:.1f} ms p99"
+        )
+    reduction = 1 - (
+        latency["serving_model"]["mean_ms"] / latency["two_input_model"]["mean_ms"]
+    )
+    tf.compat.v1.logging.info(f"Latency reduction: {100 * reduction:.1f}%")
+
+    with open(os.path.join(export_dir, "latency.json"), "w") as f:
+        json.dump(latency, f, indent=2)
+
+    return latency
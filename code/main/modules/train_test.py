@@ -5,15 +5,242 @@ import os
 import tensorflow_model_optimization as tfmot
 from pathlib import Path
 import modules.config as cn
-from modules.models import get_model
-from modules.preprocessing import fetch_data
+from modules.models import get_model, get_feature_model
+from modules.preprocessing import (
+    fetch_data,
+    fetch_test_data,
+    fetch_validation_data,
+    load_manifest,
+    train_steps,
+)
 import modules.utils as utils
+from modules.serving import build_serving_model, export_serving_model
+from modules.qat import train_qat
 import numpy as np
-import pandas as pd
 import seaborn as sn
 import matplotlib.pyplot as plt
-from sklearn.metrics import classification_report, roc_auc_score
-from scipy.special import softmax
+
+
+def get_optimizer(params):
+    """[Adam optimizer, wrapped for dynamic loss scaling under mixed_float16. The
+    bfloat16 range is the same as float32, it doesn't need loss scaling.]"""
+    optimizer = keras.optimizers.Adam(learning_rate=params["learning_rate"])
+    if params["precision"] == "mixed_float16":
+        optimizer = tf.keras.mixed_precision.experimental.LossScaleOptimizer(
+            optimizer, loss_scale="dynamic"
+        )
+
+    return optimizer
+
+
+def make_train_step(model, params):
+    """[This method builds the training step of the custom loop: the classification
+    loss, the domain loss of model.losses & the gradients are computed in a single
+    function, XLA compiled with jit_compile.]"""
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+    optimizer = model.optimizer
+    loss_scaling = isinstance(
+        optimizer, tf.keras.mixed_precision.experimental.LossScaleOptimizer
+    )
+
+    @tf.function(experimental_compile=params["jit_compile"])
+    def train_step(x, y):
+        with tf.GradientTape() as tape:
+            logits = model(x, training=True)
+            domain_loss = tf.add_n(model.losses)
+            loss = loss_fn(y, logits) + domain_loss
+            scaled_loss = optimizer.get_scaled_loss(loss) if loss_scaling else loss
+
+        gradients = tape.gradient(scaled_loss, model.trainable_variables)
+        if loss_scaling:
+            gradients = optimizer.get_unscaled_gradients(gradients)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+
+        return loss, domain_loss, logits
+
+    return train_step
+
+
+def make_accumulation_step(model, params):
+    """[This method builds a training step which accumulates the gradients of
+    accum_steps micro-batches, while the domain loss is computed over the features
+    of the whole batch. A first forward pass without gradients collects the
+    features of all the micro-batches, then every micro-batch is run again with
+    its own features in place of their constant copy, so the summed gradients are
+    the gradients of the large batch domain loss. Only one micro-batch is kept for
+    the backward pass at a time.]"""
+    assert (
+        params["loss_function"] not in cn.STATEFUL_LOSSES
+    ), "Gradient accumulation calls the domain loss every step, use a stateless loss"
+    assert not params[
+        "align_layers"
+    ], "Gradient accumulation aligns the pooled features only, drop align_layers"
+    feature_model = get_feature_model(model)
+    domain_loss_fn = cn.LOSS[params["loss_function"]]
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(
+        from_logits=True, reduction=tf.keras.losses.Reduction.SUM
+    )
+    optimizer = model.optimizer
+    loss_scaling = isinstance(
+        optimizer, tf.keras.mixed_precision.experimental.LossScaleOptimizer
+    )
+    accum_steps = params["accum_steps"]
+
+    def micro_batch(tensor, i):
+        # Sliced by its own size, the target batch differs with source_ratio
+        micro_batch_size = -(-tf.shape(tensor)[0] // accum_steps)
+        return tensor[i * micro_batch_size : (i + 1) * micro_batch_size]
+
+    @tf.function(experimental_compile=params["jit_compile"])
+    def train_step(x, y):
+        batch_size = tf.cast(tf.shape(y)[0], tf.float32)
+
+        # Constant features of the whole batch
+        source_features, target_features = [], []
+        for i in range(accum_steps):
+            _, source_op, target_op = feature_model(
+                [micro_batch(x[0], i), micro_batch(x[1], i)], training=True
+            )
+            source_features.append(tf.stop_gradient(source_op))
+            target_features.append(tf.stop_gradient(target_op))
+
+        gradients = [tf.zeros_like(v) for v in model.trainable_variables]
+        logits, loss, domain_loss = [], 0.0, 0.0
+        for i in range(accum_steps):
+            with tf.GradientTape() as tape:
+                micro_logits, source_op, target_op = feature_model(
+                    [micro_batch(x[0], i), micro_batch(x[1], i)], training=True
+                )
+                domain_loss = domain_loss_fn(
+                    source_output=tf.concat(
+                        source_features[:i] + [source_op] + source_features[i + 1 :], 0
+                    ),
+                    target_output=tf.concat(
+                        target_features[:i] + [target_op] + target_features[i + 1 :], 0
+                    ),
+                    percent_lambda=params["lambda_loss"],
+                )
+                classification_loss = loss_fn(micro_batch(y, i), micro_logits)
+                micro_loss = classification_loss / batch_size + domain_loss
+                scaled_loss = micro_loss
+                if loss_scaling:
+                    scaled_loss = optimizer.get_scaled_loss(micro_loss)
+
+            micro_gradients = tape.gradient(scaled_loss, model.trainable_variables)
+            if loss_scaling:
+                micro_gradients = optimizer.get_unscaled_gradients(micro_gradients)
+            gradients = [
+                g if mg is None else g + mg for g, mg in zip(gradients, micro_gradients)
+            ]
+            logits.append(micro_logits)
+            loss += classification_loss / batch_size
+
+        # Every micro-batch holds the gradient of its own part of the domain loss
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+
+        return loss + domain_loss, domain_loss, tf.concat(logits, 0)
+
+    return train_step
+
+
+def custom_fit(model, ds_train, ds_test, params, callbacks, train_step=None):
+    """[This method replaces model.fit with an explicit training loop around
+    make_train_step. It drives the same callbacks with the same logs (loss,
+    CORAL_loss, accuracy & their val_ counterparts), so the logging, checkpoints,
+    early stopping & LR schedule behave as with model.fit.]
+
+    Args:
+        model ([keras model]): [compiled model from get_model]
+        ds_train ([tf dataset]): [training dataset]
+        ds_test ([tf dataset]): [validation dataset, None leaves the validation to
+        the callbacks]
+        params ([dict]): [Argparse dictionary]
+        callbacks ([list]): [keras callbacks]
+        train_step ([function], optional): [training step returning the loss, domain
+        loss & logits]. Defaults to make_train_step(model, params).
+
+    Returns:
+        [keras History]: [training history]
+    """
+    train_step = train_step or make_train_step(model, params)
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+    metrics = {
+        "loss": tf.keras.metrics.Mean(),
+        "CORAL_loss": tf.keras.metrics.Mean(),
+        "accuracy": tf.keras.metrics.SparseCategoricalAccuracy(),
+    }
+    val_metrics = {
+        "val_loss": tf.keras.metrics.Mean(),
+        "val_CORAL_loss": tf.keras.metrics.Mean(),
+        "val_accuracy": tf.keras.metrics.SparseCategoricalAccuracy(),
+    }
+    if ds_test is None:
+        val_metrics = {}
+
+    @tf.function
+    def train_fn(x, y):
+        loss, domain_loss, logits = train_step(x, y)
+        metrics["loss"].update_state(loss)
+        metrics["CORAL_loss"].update_state(domain_loss)
+        metrics["accuracy"].update_state(y, logits)
+
+    @tf.function(experimental_compile=params["jit_compile"])
+    def test_step(x, y):
+        logits = model(x, training=False)
+        domain_loss = tf.add_n(model.losses)
+        return loss_fn(y, logits) + domain_loss, domain_loss, logits
+
+    @tf.function
+    def test_fn(x, y):
+        loss, domain_loss, logits = test_step(x, y)
+        val_metrics["val_loss"].update_state(loss)
+        val_metrics["val_CORAL_loss"].update_state(domain_loss)
+        val_metrics["val_accuracy"].update_state(y, logits)
+
+    # The infinite sampler keeps a single iterator across the epochs
+    steps = train_steps(params)
+    iterator = iter(ds_train) if steps else None
+
+    callback_list = tf.keras.callbacks.CallbackList(
+        callbacks,
+        add_history=True,
+        add_progbar=True,
+        model=model,
+        verbose=1,
+        epochs=params["epochs"],
+        steps=steps,
+    )
+
+    model.stop_training = False
+    callback_list.on_train_begin()
+    for epoch in range(params["epochs"]):
+        for metric in list(metrics.values()) + list(val_metrics.values()):
+            metric.reset_states()
+        callback_list.on_epoch_begin(epoch)
+
+        batches = (next(iterator) for _ in range(steps)) if steps else ds_train
+        for step, (x, y) in enumerate(batches):
+            callback_list.on_train_batch_begin(step)
+            train_fn(x, y)
+            callback_list.on_train_batch_end(
+                step, {name: metric.result() for name, metric in metrics.items()}
+            )
+
+        if ds_test is not None:
+            for x, y in ds_test:
+                test_fn(x, y)
+
+        logs = {
+            name: float(metric.result())
+            for name, metric in list(metrics.items()) + list(val_metrics.items())
+        }
+        callback_list.on_epoch_end(epoch, logs)
+        if model.stop_training:
+            break
+
+    callback_list.on_train_end()
+
+    return model.history
 
 
 def train_test(params):
@@ -32,11 +259,30 @@ def train_test(params):
 
     if not params["technique"]:
         my_dir = my_dir + "_Original"
+    elif params["shared_backbone"]:
+        my_dir = my_dir + "_SharedBN"
+        if params["adapter_dim"]:
+            my_dir = my_dir + "_Adapter" + str(params["adapter_dim"])
 
     if params["prune"]:
         tf.compat.v1.logging.info("Pruning is activated")
         my_dir = my_dir + "_" + str(params["prune_val"])
 
+    if params["qat"]:
+        my_dir = my_dir + "_QAT"
+
+    if params["precision"] != "float32":
+        my_dir = my_dir + "_" + params["precision"]
+
+    if params["train_loop"] == "custom":
+        my_dir = my_dir + ("_XLA" if params["jit_compile"] else "_CustomLoop")
+
+    if params["accum_steps"] > 1:
+        my_dir = my_dir + "_Accum" + str(params["accum_steps"])
+
+    if params["align_layers"]:
+        my_dir = my_dir + "_MultiLayer" + str(len(utils.align_layers(params)))
+
     assert os.path.exists(cn.LOGS_DIR), "LOGS_DIR doesn't exist"
     experiment_logs_path = os.path.join(cn.LOGS_DIR, my_dir)
     Path(experiment_logs_path).mkdir(parents=True, exist_ok=True)
@@ -51,6 +297,12 @@ def train_test(params):
         "Fetched the architecture function: " + params["architecture"]
     )
 
+    if params["precision"] != "float32":
+        # The backbones run in the lower precision, see get_model for the layers
+        # which are kept in float32
+        tf.compat.v1.logging.info(f"Using {params['precision']} precision policy")
+        tf.keras.mixed_precision.experimental.set_policy(params["precision"])
+
     if params["use_multiGPU"]:
         # Create a MirroredStrategy.
         strategy = tf.distribute.MirroredStrategy()
@@ -70,13 +322,17 @@ def train_test(params):
                 prune=params["prune"],
                 prune_val=params["prune_val"],
                 technique=params["technique"],
+                align_layers=utils.align_layers(params),
+                sketch_dim=params["sketch_dim"],
+                shared_backbone=params["shared_backbone"],
+                adapter_dim=params["adapter_dim"],
             )
 
             # print(model.summary())
             """ Model Compilation """
             tf.compat.v1.logging.info("Compiling the model ...")
             model.compile(
-                optimizer=keras.optimizers.Adam(learning_rate=params["learning_rate"]),
+                optimizer=get_optimizer(params),
                 loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
                 metrics=["accuracy"],
             )
@@ -94,35 +350,91 @@ def train_test(params):
             prune=params["prune"],
             prune_val=params["prune_val"],
             technique=params["technique"],
+            align_layers=utils.align_layers(params),
+            sketch_dim=params["sketch_dim"],
+            shared_backbone=params["shared_backbone"],
+            adapter_dim=params["adapter_dim"],
         )
 
         # print(model.summary())
         """ Model Compilation """
         tf.compat.v1.logging.info("Compiling the model ...")
         model.compile(
-            optimizer=keras.optimizers.Adam(learning_rate=params["learning_rate"]),
+            optimizer=get_optimizer(params),
             loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
             metrics=["accuracy"],
         )
 
+    model_size = utils.log_model_size(model, params)
+
     """ Create callbacks """
     tf.compat.v1.logging.info("Creating the callbacks ...")
     callbacks, log_dir = utils.callbacks_fn(params, my_dir)
+    throughput = utils.ThroughputCallback(params["batch_size"])
+    callbacks.append(throughput)
+    if params["val_mode"] == "branch":
+        tf.compat.v1.logging.info(
+            f"Validating the prediction branch every {params['val_freq']} epochs"
+        )
+        callbacks.insert(
+            0,
+            utils.BranchValidation(
+                build_serving_model(model),
+                fetch_validation_data(params),
+                params["val_freq"],
+                params["epochs"],
+            ),
+        )
 
     tf.compat.v1.logging.info("Calling data preprocessing pipeline...")
-    ds_train, ds_test = fetch_data(params)
+    if params["accum_steps"] > 1:
+        # The datasets hold the whole batch, which the train step splits into
+        # micro-batches of batch_size
+        data_params = dict(
+            params, batch_size=params["batch_size"] * params["accum_steps"]
+        )
+        ds_train, ds_test = fetch_data(data_params)
+        ds_train = ds_train.filter(
+            lambda x, y: tf.shape(y)[0] == data_params["batch_size"]
+        )
+        throughput.batch_size = data_params["batch_size"]
+    else:
+        ds_train, ds_test = fetch_data(params)
+
+    # The branch validation callback replaces the validation of the whole model, the
+    # full target set is still evaluated once after the training
+    ds_val = None if params["val_mode"] == "branch" else ds_test
 
     """ Model Training """
     tf.compat.v1.logging.info("Training Started....")
 
     hist = None
-    hist = model.fit(
-        ds_train,
-        validation_data=ds_test,
-        epochs=params["epochs"],
-        verbose=1,
-        callbacks=callbacks,
-    )
+    if params["accum_steps"] > 1:
+        tf.compat.v1.logging.info(
+            f"Accumulating the gradients of {params['accum_steps']} micro-batches"
+        )
+        hist = custom_fit(
+            model,
+            ds_train,
+            ds_val,
+            data_params,
+            callbacks,
+            train_step=make_accumulation_step(model, params),
+        )
+    elif params["train_loop"] == "custom":
+        tf.compat.v1.logging.info(
+            f"Custom training loop, XLA compiled: {params['jit_compile']}"
+        )
+        hist = custom_fit(model, ds_train, ds_val, params, callbacks)
+    else:
+        hist = model.fit(
+            ds_train,
+            validation_data=ds_val,
+            epochs=params["epochs"],
+            steps_per_epoch=train_steps(params),
+            verbose=1,
+            callbacks=callbacks,
+        )
     tf.compat.v1.logging.info("Training finished....")
 
     """ Plotting """
@@ -130,7 +442,6 @@ def train_test(params):
     utils.loss_accuracy_plots(
         hist=hist,
         log_dir=log_dir,
-        params=params,
     )
 
     """ Evaluate on Target Dataset"""
@@ -138,6 +449,9 @@ def train_test(params):
     tf.compat.v1.logging.info(
         f"Test Set evaluation results for run {Path(log_dir).name} : Accuracy: {results[1]}, Loss: {results[0]}"
     )
+    utils.log_run_summary(
+        params, log_dir, results, **throughput.summary(), **model_size
+    )
 
     """ Model Saving """
     if params["save_model"]:
@@ -149,6 +463,14 @@ def train_test(params):
         model.save(os.path.join(model_path, "model"))
         tf.compat.v1.logging.info(f"Model successfully saved at: {model_path}")
 
+        if not params["prune"]:
+            export_serving_model(
+                build_serving_model(model),
+                os.path.join(model_path, "serving_model"),
+                params["batch_size"],
+                params["input_shape"],
+            )
+
     """ Pruned Model Saving """
     if params["prune"]:
         model_for_export = tfmot.sparsity.keras.strip_pruning(model)
@@ -172,12 +494,19 @@ def train_test(params):
             % (utils.get_gzipped_model_size(model_for_export))
         )
 
+    """ Quantization Aware Training """
+    if params["qat"]:
+        tf.compat.v1.logging.info("Quantization aware training of the pruned model...")
+        train_qat(model, params, ds_train, ds_test, log_dir)
+
     return model, hist, results
 
 
 def evaluate(model_path, params, figsize=(20, 15)):
     """[This method generates a Heat-Map, provides Confusion matrix and provides
-    classification report and AUC score.]
+    classification report and AUC score. The test dataset is predicted in a single
+    streaming pass, see utils.StreamingEvaluation, the labels, predictions &
+    probabilities are only saved with save_probabilities.]
 
     Args:
         model_path ([keras.Model]): [path of trained keras model]
@@ -196,47 +525,40 @@ def evaluate(model_path, params, figsize=(20, 15)):
     utils.define_logger(os.path.join(files_path, "evaluations.log"))
 
     tf.compat.v1.logging.info("Fetch the test dataset ...")
-    _, ds_test = fetch_data(params)
-
-    true_categories = tf.concat([y for x, y in ds_test], axis=0)
-    np.save(os.path.join(files_path, "y_true"), true_categories.numpy())
+    ds_test = fetch_test_data(params)
+    _, target_domain = cn.DOMAIN_PAIRS[cn.DATASET_COMBINATION[params["combination"]]]
 
     tf.compat.v1.logging.info("Loading the trained model ...")
-    model = keras.models.load_model(model_path)
-
-    tf.compat.v1.logging.info("Recompiling the model ...")
-    model.compile(
-        optimizer=keras.optimizers.Adam(learning_rate=params["learning_rate"]),
-        loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
-        metrics=["accuracy"],
+    model = keras.models.load_model(model_path, custom_objects=cn.CUSTOM_OBJECTS)
+    # The test batches feed the same images to both branches, only the prediction
+    # branch is run
+    serving_model = build_serving_model(model)
+
+    @tf.function
+    def predict_step(x):
+        return tf.nn.softmax(serving_model(x[0], training=False))
+
+    evaluation = utils.StreamingEvaluation(
+        params["output_classes"],
+        num_images=load_manifest(target_domain)["num_images"],
+        output_dir=files_path if params["save_probabilities"] else None,
     )
 
     tf.compat.v1.logging.info("Predict the classes on the test dataset ...")
-    y_pred = model.predict(ds_test)
-    np.save(os.path.join(files_path, "y_prob"), y_pred)
-
-    predicted_categories = tf.argmax(y_pred, axis=1)
-    np.save(
-        os.path.join(files_path, "predicted_categories"), predicted_categories.numpy()
-    )
+    for x, y in ds_test:
+        evaluation.update(y.numpy(), predict_step(x).numpy())
+    evaluation.close()
 
     tf.compat.v1.logging.info("Generating Classification Report ...")
-    report = classification_report(
-        true_categories, predicted_categories, output_dict=True
-    )
-
-    df = pd.DataFrame(report).transpose()
+    df = evaluation.report()
     df.to_excel(os.path.join(files_path, "report.xlsx"))
     df = df.sort_values("f1-score")
     df.to_excel(os.path.join(files_path, "sorted.xlsx"))
 
-    score = roc_auc_score(true_categories, softmax(y_pred, axis=1), multi_class="ovr")
+    score = float(evaluation.auc.result())
     tf.compat.v1.logging.info("AUC score: " + str(score))
 
-    conf_matrix = tf.math.confusion_matrix(
-        labels=true_categories,
-        predictions=predicted_categories,
-    ).numpy()
+    conf_matrix = evaluation.confusion
     np.save(os.path.join(files_path, "conf_matrix"), conf_matrix)
 
     tf.compat.v1.logging.info("Generating Heatmaps ...")
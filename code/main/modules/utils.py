@@ -12,6 +12,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 import datetime
 import os
+import time
+import resource
+import tempfile
+import zipfile
+import pandas as pd
 
 
 def define_logger(log_file):
@@ -125,16 +130,20 @@ def callbacks_fn(params, my_dir):
     tf.compat.v1.logging.info(f"Model CSV logs path: {csv}")
     callback_list.append(csv_logger)
 
+    # BranchValidation repeats the last val_accuracy between its validations, the
+    # patience counts the same number of validations as for val_freq=1
+    val_freq = params["val_freq"]
+
     """Reduce LR Callback """
     reduce_lr_callback = tf.keras.callbacks.ReduceLROnPlateau(
-        monitor="val_accuracy", factor=0.4, patience=4, min_lr=0.0000001
+        monitor="val_accuracy", factor=0.4, patience=4 * val_freq, min_lr=0.0000001
     )
     callback_list.append(reduce_lr_callback)
 
     """Early Stopping Callback """
     early_stopping_callback = tf.keras.callbacks.EarlyStopping(
         monitor="val_accuracy",
-        patience=8,
+        patience=8 * val_freq,
         verbose=1,
         mode="auto",
     )
@@ -173,6 +182,367 @@ def callbacks_fn(params, my_dir):
     return callback_list, log_dir
 
 
+# Columns of run_summary.csv which tell the compared runs apart
+SUMMARY_SETTINGS = ["precision", "train_loop", "align_layers", "backbone", "validation"]
+
+
+def align_layers(params):
+    """[Names of the Xception layers given by --align_layers, as a tuple.]"""
+    return tuple(name.strip() for name in params["align_layers"].split(",") if name)
+
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    """[This callback measures the mean training step time & throughput of every
+    epoch, the validation is not included.]"""
+
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+        self.step_times = []
+        self.images_per_sec = []
+
+    def on_train_begin(self, logs=None):
+        self.train_start = time.perf_counter()
+
+    def on_train_end(self, logs=None):
+        self.wall_time = time.perf_counter() - self.train_start
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.steps = 0
+        self.train_time = 0.0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.train_time += time.perf_counter() - self.batch_start
+        self.steps += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        step_time = self.train_time / max(self.steps, 1)
+        self.step_times.append(step_time)
+        self.images_per_sec.append(self.batch_size / step_time if step_time else 0.0)
+        tf.compat.v1.logging.info(
+            f"Epoch {epoch + 1}: {1000 * step_time:.1f} ms/step, "
+            f"{self.images_per_sec[-1]:.1f} source images/sec"
+        )
+
+    def summary(self):
+        """[Mean step time & throughput, the first epoch (tracing, warm up) is left
+        out when there are more.]"""
+        step_times = self.step_times[1:] or self.step_times
+        images_per_sec = self.images_per_sec[1:] or self.images_per_sec
+        return {
+            "step_time": float(np.mean(step_times)) if step_times else None,
+            "images_per_sec": (
+                float(np.mean(images_per_sec)) if images_per_sec else None
+            ),
+            # Whole training including the validation, in seconds
+            "wall_time": getattr(self, "wall_time", None),
+            # High water mark of the host memory of the whole run, in MB
+            "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+
+class BranchValidation(tf.keras.callbacks.Callback):
+    """[This callback validates the single input prediction branch on the first
+    epoch, every val_freq epochs and on the last one, instead of the two branches &
+    the domain loss of the whole model. It has to come first in the callback list,
+    as it adds val_loss & val_accuracy to the epoch logs of the following callbacks.
+    Between validations the last values are repeated, callbacks_fn scales the
+    patience of the LR schedule & early stopping by val_freq.]
+
+    Args:
+        branch_model ([keras model]): [single input model returning the logits]
+        ds_val ([tf dataset]): [(x, y) validation dataset]
+        val_freq ([int]): [epochs between validations]
+        epochs ([int]): [training epochs]
+    """
+
+    def __init__(self, branch_model, ds_val, val_freq, epochs):
+        super().__init__()
+        self.branch_model = branch_model
+        self.ds_val = ds_val
+        self.val_freq = val_freq
+        self.epochs = epochs
+        self.val_logs = {}
+        loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+        self.val_loss = tf.keras.metrics.Mean()
+        self.val_accuracy = tf.keras.metrics.SparseCategoricalAccuracy()
+
+        @tf.function
+        def val_step(x, y):
+            logits = self.branch_model(x, training=False)
+            self.val_loss.update_state(loss_fn(y, logits))
+            self.val_accuracy.update_state(y, logits)
+
+        self.val_step = val_step
+
+    def on_epoch_end(self, epoch, logs=None):
+        # The first epoch sets the log keys of the following callbacks, e.g. the
+        # CSVLogger columns & the ModelCheckpoint file name
+        if epoch == 0 or (epoch + 1) % self.val_freq == 0 or epoch + 1 == self.epochs:
+            self.val_loss.reset_states()
+            self.val_accuracy.reset_states()
+            start = time.perf_counter()
+            for x, y in self.ds_val:
+                self.val_step(x, y)
+            self.val_logs = {
+                "val_loss": float(self.val_loss.result()),
+                "val_accuracy": float(self.val_accuracy.result()),
+            }
+            tf.compat.v1.logging.info(
+                f"Epoch {epoch + 1}: branch validation in "
+                f"{time.perf_counter() - start:.1f}s, {self.val_logs}"
+            )
+
+        if logs is not None:
+            logs.update(self.val_logs)
+
+
+def backbone_setting(params):
+    """[Backbone layout of a run: shared by MBM, separate or shared with
+    domain-specific BatchNorm (& adapter) by CDAN.]"""
+    if not params["technique"]:
+        return "shared"
+    if not params["shared_backbone"]:
+        return "separate"
+    if params["adapter_dim"]:
+        return "shared_bn_adapter" + str(params["adapter_dim"])
+    return "shared_bn"
+
+
+def log_model_size(model, params):
+    """[This method logs the parameter count & weights memory of the model, for a
+    CDAN model also against two separate backbones.]
+
+    Returns:
+        [dict]: [parameter count & weights memory in MB]
+    """
+    num_params = model.count_params()
+    weights_mb = sum(
+        weight.shape.num_elements() * weight.dtype.size for weight in model.weights
+    ) / (1024 ** 2)
+    tf.compat.v1.logging.info(
+        f"Model parameters: {num_params}, weights memory: {weights_mb:.1f} MB"
+    )
+
+    if params["technique"] and params["shared_backbone"]:
+        # Every shared layer would have its own copy with two backbones
+        source_backbone = [
+            layer for layer in model.layers if isinstance(layer, tf.keras.Model)
+        ][0]
+        separate_params = num_params + sum(
+            layer.count_params()
+            for layer in source_backbone.layers
+            if not isinstance(layer, tf.keras.layers.BatchNormalization)
+        )
+        tf.compat.v1.logging.info(
+            f"Two backbones CDAN parameters: {separate_params}, the shared backbone "
+            f"saves {separate_params - num_params} parameters "
+            f"({100 * (1 - num_params / separate_params):.1f}%)"
+        )
+
+    return {"num_params": num_params, "weights_mb": weights_mb}
+
+
+def log_run_summary(params, log_dir, results, **metrics):
+    """[This method appends a row per run to evaluation/run_summary.csv and logs the
+    runs of the same scenario & technique side by side per setting, e.g. float32 vs
+    bfloat16 or model.fit vs the XLA compiled custom loop.]
+
+    Args:
+        params ([dict]): [Argparse dictionary]
+        log_dir ([str]): [log path of the run]
+        results ([list]): [loss & accuracy on the target dataset]
+        metrics ([dict]): [additional columns, e.g. step_time & images_per_sec]
+    """
+    row = {
+        "run": os.path.join((Path(log_dir).parent).name, Path(log_dir).name),
+        "combination": params["combination"],
+        "technique": "CDAN" if params["technique"] else "MBM",
+        "precision": params["precision"],
+        "train_loop": params["train_loop"] + ("_xla" if params["jit_compile"] else ""),
+        "align_layers": params["align_layers"] or "none",
+        "backbone": backbone_setting(params),
+        "validation": params["val_mode"]
+        + (f"_every{params['val_freq']}" if params["val_freq"] > 1 else "")
+        + (f"_subset{params['val_subset']}" if params["val_subset"] < 1 else ""),
+        "batch_size": params["batch_size"],
+        "accuracy": results[1],
+        "loss": results[0],
+    }
+    row.update(metrics)
+
+    Path(cn.EVALUATION).mkdir(parents=True, exist_ok=True)
+    summary_path = os.path.join(cn.EVALUATION, "run_summary.csv")
+    df = pd.DataFrame([row])
+    if os.path.exists(summary_path):
+        df = pd.concat([pd.read_csv(summary_path), df], ignore_index=True)
+    df.to_csv(summary_path, index=False)
+
+    # Rows written before a setting existed are grouped under "none" for it
+    same_runs = df[
+        (df["combination"] == row["combination"])
+        & (df["technique"] == row["technique"])
+    ].fillna({setting: "none" for setting in SUMMARY_SETTINGS})
+    tf.compat.v1.logging.info(
+        f"Runs of {row['combination']} ({row['technique']}) by setting:\n"
+        + same_runs.groupby(SUMMARY_SETTINGS)[list(metrics) + ["accuracy"]]
+        .mean()
+        .to_string()
+    )
+
+
+class StreamingEvaluation:
+    """[This class accumulates the evaluation metrics batch by batch: the confusion
+    matrix, from which the per-class counts & the classification report are
+    derived, and the one-vs-rest AUC of every class on fixed thresholds. Its
+    memory doesn't depend on the number of images. The labels, predictions &
+    probabilities are optionally written to memory-mapped .npy files.]
+
+    Args:
+        num_classes ([int]): [number of classes]
+        num_images (int, optional): [number of images, needed by output_dir]. Defaults to None.
+        output_dir (str, optional): [directory of y_true, predicted_categories &
+        y_prob .npy files, none are written if None]. Defaults to None.
+        num_thresholds (int, optional): [thresholds of the AUC estimate]. Defaults to 1000.
+    """
+
+    def __init__(
+        self, num_classes, num_images=None, output_dir=None, num_thresholds=1000
+    ):
+        self.num_classes = num_classes
+        self.confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+        # Mean of the per-class AUCs, i.e. the macro one-vs-rest AUC
+        self.auc = tf.keras.metrics.AUC(num_thresholds=num_thresholds, multi_label=True)
+        self.offset = 0
+        self.arrays = {}
+        if output_dir:
+            for name, dtype, shape in (
+                ("y_true", np.int64, (num_images,)),
+                ("predicted_categories", np.int64, (num_images,)),
+                ("y_prob", np.float32, (num_images, num_classes)),
+            ):
+                self.arrays[name] = np.lib.format.open_memmap(
+                    os.path.join(output_dir, name + ".npy"),
+                    mode="w+",
+                    dtype=dtype,
+                    shape=shape,
+                )
+
+    def update(self, labels, probabilities):
+        """[Adds a batch of integer labels & class probabilities.]"""
+        labels = np.asarray(labels).astype(np.int64)
+        probabilities = np.asarray(probabilities)
+        predictions = probabilities.argmax(axis=1)
+
+        np.add.at(self.confusion, (labels, predictions), 1)
+        self.auc.update_state(tf.one_hot(labels, self.num_classes), probabilities)
+
+        batch = slice(self.offset, self.offset + len(labels))
+        for name, values in (
+            ("y_true", labels),
+            ("predicted_categories", predictions),
+            ("y_prob", probabilities),
+        ):
+            if name in self.arrays:
+                self.arrays[name][batch] = values
+        self.offset += len(labels)
+
+    def report(self):
+        """[Classification report with the rows & columns of sklearn's
+        classification_report, computed from the confusion matrix.]"""
+        true_positives = np.diag(self.confusion).astype(np.float64)
+        support = self.confusion.sum(axis=1)
+        predicted = self.confusion.sum(axis=0)
+
+        def divide(a, b):
+            return np.divide(a, b, out=np.zeros_like(true_positives), where=b > 0)
+
+        precision = divide(true_positives, predicted)
+        recall = divide(true_positives, support)
+        f1 = divide(2 * precision * recall, precision + recall)
+        scores = np.stack([precision, recall, f1], axis=1)
+
+        total = support.sum()
+        accuracy = true_positives.sum() / max(total, 1)
+        df = pd.DataFrame(
+            np.concatenate(
+                [
+                    scores,
+                    [[accuracy] * 3],
+                    [scores.mean(axis=0)],
+                    [support @ scores / max(total, 1)],
+                ]
+            ),
+            columns=["precision", "recall", "f1-score"],
+            index=[str(label) for label in range(self.num_classes)]
+            + ["accuracy", "macro avg", "weighted avg"],
+        )
+        df["support"] = list(support) + [total] * 3
+
+        return df
+
+    def close(self):
+        """[Flushes the memory-mapped files to disk.]"""
+        for array in self.arrays.values():
+            array.flush()
+        self.arrays = {}
+
+
+def get_gzipped_file_size(file_path):
+    """[Size in bytes of the zip compressed file.]"""
+    _, zipped_file = tempfile.mkstemp(".zip")
+    with zipfile.ZipFile(zipped_file, "w", compression=zipfile.ZIP_DEFLATED) as f:
+        f.write(file_path)
+    size = os.path.getsize(zipped_file)
+    os.remove(zipped_file)
+
+    return size
+
+
+def get_gzipped_model_size(model):
+    """[Size in bytes of the zip compressed weights of the model, the zeros of a
+    pruned model compress away.]"""
+    _, weights_file = tempfile.mkstemp(".h5")
+    model.save_weights(weights_file)
+    size = get_gzipped_file_size(weights_file)
+    os.remove(weights_file)
+
+    return size
+
+
+def measure_latency(predict_fn, inputs, runs=50, warmup=5):
+    """[This method measures the latency of a prediction function, the first calls
+    (tracing, warm up) are left out.]
+
+    Args:
+        predict_fn ([function]): [prediction function, called on inputs]
+        inputs ([tf tensor or list]): [batch of inputs]
+        runs (int, optional): [timed calls]. Defaults to 50.
+        warmup (int, optional): [untimed calls before]. Defaults to 5.
+
+    Returns:
+        [dict]: [mean, p50 & p99 latency in ms]
+    """
+    for _ in range(warmup):
+        tf.nest.map_structure(lambda x: x.numpy(), predict_fn(inputs))
+
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        # numpy() waits for the asynchronous device computations
+        tf.nest.map_structure(lambda x: x.numpy(), predict_fn(inputs))
+        latencies.append(1000 * (time.perf_counter() - start))
+
+    return {
+        "mean_ms": float(np.mean(latencies)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
 def pruning_plots(
     rows,
     cols,
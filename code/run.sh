@@ -10,3 +10,23 @@ python3 main/main.py --lambda_loss=0.50  --batch_size=16 --architecture="Xceptio
 
 # Trigger Pruned MBM without data augmentation for A->W Scenario
 python3 main/main.py --lambda_loss=0.50 --batch_size=16 --architecture="Xception" --resize=299  --epochs=40 --combination="Amazon_to_Webcam" --output_classes=31 --save_model --save_weights --prune --prune_val=0.1
+
+# Compare MBM in float32 & mixed float16 precision on a GPU for A->W Scenario, see evaluation/run_summary.csv
+python3 main/main.py --lambda_loss=0.50 --batch_size=16 --architecture="Xception" --resize=299  --epochs=40 --combination="Amazon_to_Webcam" --output_classes=31 --precision="float32"
+python3 main/main.py --lambda_loss=0.50 --batch_size=16 --architecture="Xception" --resize=299  --epochs=40 --combination="Amazon_to_Webcam" --output_classes=31 --precision="mixed_float16"
+
+# Compare model.fit & the XLA compiled custom training loop for A->W Scenario, see evaluation/run_summary.csv
+python3 main/main.py --lambda_loss=0.50 --batch_size=16 --architecture="Xception" --resize=299  --epochs=40 --combination="Amazon_to_Webcam" --output_classes=31 --train_loop="custom" --jit_compile
+
+# Align two intermediate Xception blocks as well for A->W Scenario, see evaluation/run_summary.csv
+python3 main/main.py --lambda_loss=0.50 --batch_size=16 --architecture="Xception" --resize=299  --epochs=40 --combination="Amazon_to_Webcam" --output_classes=31 --align_layers="block4_sepconv2_bn,block13_sepconv2_bn" --sketch_dim=64
+
+# Compare the two backbones & the shared backbone CDAN for A->W Scenario, see evaluation/run_summary.csv
+python3 main/main.py --lambda_loss=0.50 --batch_size=16 --architecture="Xception" --resize=299  --epochs=40 --combination="Amazon_to_Webcam" --output_classes=31 --technique
+python3 main/main.py --lambda_loss=0.50 --batch_size=16 --architecture="Xception" --resize=299  --epochs=40 --combination="Amazon_to_Webcam" --output_classes=31 --technique --shared_backbone --adapter_dim=64
+
+# Validate only the prediction branch on a stratified subset for A->W Scenario, see evaluation/run_summary.csv
+python3 main/main.py --lambda_loss=0.50 --batch_size=16 --architecture="Xception" --resize=299  --epochs=40 --combination="Amazon_to_Webcam" --output_classes=31 --val_mode="branch" --val_freq=2 --val_subset=0.25
+
+# Pruned & quantization aware trained CDAN for A->W Scenario, int8 TFLite export
+python3 main/main.py --lambda_loss=0.50 --batch_size=16 --architecture="Xception" --resize=299  --epochs=40 --combination="Amazon_to_Webcam" --output_classes=31 --technique --prune --prune_val=0.3 --qat --qat_epochs=2
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules are imported the same way as by main.py, from code/main
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "main"))
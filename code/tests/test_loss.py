@@ -0,0 +1,136 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from modules.loss import CORAL, GRAM_MIN_DIM, RunningCORAL, covariance_loss, gram_loss
+from modules.models import get_head_model
+
+
+def centred_features(batch_size, d, seed):
+    x = np.random.RandomState(seed).randn(batch_size, d).astype(np.float32)
+    return tf.constant(x - x.mean(axis=0, keepdims=True))
+
+
+def numpy_coral(source, target):
+    d = source.shape[1]
+    cs = np.cov(source, rowvar=False, bias=True)
+    ct = np.cov(target, rowvar=False, bias=True)
+    return np.sum((cs - ct) ** 2) / (4 * d * d)
+
+
+@pytest.mark.parametrize(
+    "source_batch_size, target_batch_size, d",
+    [
+        (5, 7, 64),  # ns + nt < d, the Gram form of CORAL
+        (16, 16, 2048),
+        (40, 24, 32),  # ns + nt >= d, the covariance form of CORAL
+        (9, 9, 18),
+    ],
+)
+def test_gram_loss_equals_covariance_loss(source_batch_size, target_batch_size, d):
+    xm = centred_features(source_batch_size, d, seed=0)
+    xmt = centred_features(target_batch_size, d, seed=1)
+
+    np.testing.assert_allclose(
+        gram_loss(xm, xmt).numpy(), covariance_loss(xm, xmt).numpy(), rtol=1e-4
+    )
+
+
+@pytest.mark.parametrize(
+    "source_batch_size, target_batch_size, d", [(5, 7, 64), (40, 24, 32)]
+)
+def test_coral_matches_numpy_covariances(source_batch_size, target_batch_size, d):
+    rng = np.random.RandomState(2)
+    source = rng.randn(source_batch_size, d).astype(np.float32)
+    target = 2 * rng.randn(target_batch_size, d).astype(np.float32) + 1
+
+    np.testing.assert_allclose(
+        CORAL(tf.constant(source), tf.constant(target), percent_lambda=1.0).numpy(),
+        numpy_coral(source.astype(np.float64), target.astype(np.float64)),
+        rtol=1e-4,
+    )
+
+
+@pytest.mark.parametrize("d", [8, GRAM_MIN_DIM])
+def test_coral_builds_into_keras_model(d):
+    # The batch size is unknown while the functional model is built
+    inputs = [tf.keras.Input((16,)), tf.keras.Input((16,))]
+    dense = tf.keras.layers.Dense(d)
+    source, target = dense(inputs[0]), dense(inputs[1])
+    model = tf.keras.Model(inputs, tf.keras.layers.Dense(3)(source))
+    model.add_loss(CORAL(source, target))
+    model.compile(
+        optimizer="adam",
+        loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+    )
+
+    rng = np.random.RandomState(3)
+    x = rng.randn(8, 16).astype(np.float32)
+    history = model.fit(
+        [x, 2 * x + 1], rng.randint(0, 3, 8), batch_size=4, epochs=1, verbose=0
+    )
+    assert np.isfinite(history.history["loss"][0])
+
+
+def test_coral_head_model_fit_step():
+    model = get_head_model(feature_dim=32, additional_loss="CORAL", num_classes=5)
+    model.compile(
+        optimizer="adam",
+        loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+        metrics=["accuracy"],
+    )
+
+    rng = np.random.RandomState(4)
+    source = rng.randn(8, 32).astype(np.float32)
+    target = rng.randn(8, 32).astype(np.float32)
+    history = model.fit(
+        [source, target], rng.randint(0, 5, 8), batch_size=8, epochs=1, verbose=0
+    )
+    assert np.isfinite(history.history["CORAL_loss"][0])
+
+
+def test_running_coral_statistics_after_two_steps():
+    momentum = 0.9
+    layer = RunningCORAL(momentum=momentum)
+    rng = np.random.RandomState(5)
+    batches = [
+        (rng.randn(6, 4).astype(np.float32), 3 * rng.randn(10, 4).astype(np.float32))
+        for _ in range(2)
+    ]
+    for source, target in batches:
+        loss = layer([tf.constant(source), tf.constant(target)], training=True)
+
+    def running(index):
+        # Bias corrected moving averages of the means & second moments
+        correction = 1 - momentum ** 2
+        mean = sum(
+            momentum ** (1 - step) * (1 - momentum) * batch[index].mean(axis=0)
+            for step, batch in enumerate(batches)
+        )
+        moment = sum(
+            momentum ** (1 - step)
+            * (1 - momentum)
+            * batch[index].T.dot(batch[index])
+            / len(batch[index])
+            for step, batch in enumerate(batches)
+        )
+        return (
+            mean,
+            moment,
+            moment / correction - np.outer(mean / correction, mean / correction),
+        )
+
+    source_mean, source_moment, source_cov = running(0)
+    target_mean, target_moment, target_cov = running(1)
+    assert float(layer.steps.numpy()) == 2
+    np.testing.assert_allclose(layer.source_mean.numpy(), source_mean, rtol=1e-5)
+    np.testing.assert_allclose(layer.source_moment.numpy(), source_moment, rtol=1e-5)
+    np.testing.assert_allclose(layer.target_mean.numpy(), target_mean, rtol=1e-5)
+    np.testing.assert_allclose(layer.target_moment.numpy(), target_moment, rtol=1e-5)
+    np.testing.assert_allclose(
+        loss.numpy(), np.sum((source_cov - target_cov) ** 2) / (4 * 4 * 4), rtol=1e-4
+    )
+
+    # Inference reads the statistics without updating them
+    layer([tf.constant(source), tf.constant(target)], training=False)
+    assert float(layer.steps.numpy()) == 2
+    np.testing.assert_allclose(layer.source_mean.numpy(), source_mean, rtol=1e-5)
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from modules.config import XLA_LOSSES
+from modules.models import get_head_model
+from modules.train_test import make_train_step
+
+
+@pytest.mark.parametrize("loss_function", XLA_LOSSES)
+def test_jit_compiled_train_step(loss_function):
+    model = get_head_model(feature_dim=32, additional_loss=loss_function, num_classes=5)
+    model.compile(optimizer=tf.keras.optimizers.Adam())
+    train_step = make_train_step(model, {"jit_compile": True})
+
+    rng = np.random.RandomState(0)
+    x = (
+        tf.constant(rng.randn(8, 32).astype(np.float32)),
+        tf.constant(rng.randn(8, 32).astype(np.float32)),
+    )
+    loss, domain_loss, logits = train_step(x, tf.constant(rng.randint(0, 5, 8)))
+
+    assert np.isfinite(float(loss)) and np.isfinite(float(domain_loss))
+    assert logits.shape == (8, 5)